@@ -6,9 +6,12 @@ suite.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 import time
 import sys
+import os
+import json
+import functools
+import argparse
 
 
 CRED = "\x1b[1;31m"
@@ -19,111 +22,343 @@ CEND = "\33[0m"
 
 
 def get_data(uuts, args, channels):
+    """
+    Offloads the capture from every UUT. For pre_post with
+    args.offload_windows set, only the rows in get_offload_windows are kept,
+    and the read stops at the end of the last window. The windows used are
+    left in args.offload_windows_used (None for a full offload).
+    """
     data = []
     sample_counter = []
     events = []
     data_size = 4 if uuts[0].s0.data32 == '1' else 2
+    rows = None
+    args.offload_windows_used = None
+    if args.offload_windows == 1 and args.test == "pre_post":
+        args.offload_windows_used = get_offload_windows(args.pre + args.post, args.pre, wave_length=args.clock_divisor,
+                                                        margin=args.window_margin, block_len=args.block_len,
+                                                        tail=args.offload_tail, blocks=args.random_blocks)
+        rows = get_window_rows(args.offload_windows_used)
+        print_window_coverage(args.offload_windows_used, args.pre + args.post)
+
     for index, uut in enumerate(uuts):
-        if args.demux == 1:
+        if args.demux == 1 and rows is None:
             data.append(np.column_stack((uut.read_channels(tuple(channels[index])))))
-        else:
+        elif args.demux == 1:
+            data.append(np.column_stack([uut.read_chan(ch, rows[-1] + 1, data_size=data_size)[rows] for ch in channels[index]]))
+        elif rows is None:
             data.append(uut.read_chan(0, 0, data_size=data_size))
             sample_counter.append(extract_sample_counter(data[index], get_agg_chans(uut), uut.nchan()))
             data[index] = data[index].reshape((-1, int(uut.s0.NCHAN)))
             data[index] = data[index][:,np.array(channels[index])-1]
+        else:
+            nchan = int(uut.s0.NCHAN)
+            raw = uut.read_chan(0, (rows[-1] + 1) * nchan, data_size=data_size)
+            raw = raw[:raw.shape[-1] // nchan * nchan].reshape((-1, nchan))[rows]
+            sample_counter.append(extract_sample_counter(raw.ravel(), get_agg_chans(uut), uut.nchan()))
+            data.append(raw[:,np.array(channels[index])-1])
+            records = get_es_records(uut, data=raw)
+            records["index"] = rows[records["index"]]
+            events.append(records)
 
 
-        if args.demux == 0:
-            events.append(get_es_indices(uut, human_readable=1, return_hex_string=1))
+        if args.demux == 0 and rows is None:
+            events.append(get_es_records(uut))
 
     return data, events, sample_counter
 
 
-
-def get_ideal_rgm_data(final_len=75000, es_len=1):
+def get_offload_windows(total_len, pre, wave_length=20000, margin=1000, block_len=4096, tail=0, blocks=8, rng=None):
     """
+    Returns the windows of a pre_post capture to offload, as sorted, merged
+    (start, stop) sample pairs. The signal is only in the wave_length samples
+    either side of the PRE/POST boundary, and the rest is checked against
+    zeros.
+
+    The UUT streams the capture from the start, so the read stops at the end
+    of the last window. The random blocks are drawn from before the end of
+    the boundary window, and the rest of POST (most of the capture with the
+    default lengths) is not checked at all. To reach the tail the whole
+    buffer has to be read, so with tail=1 the one window is the whole
+    capture, and all of it is checked.
+
     Parameter descriptions:
-        final_len: Length of the full rtm data.
-        es_len:    Number of samples in the ES.
+        total_len:   PRE + POST in samples.
+        pre:         PRE in samples, the index of the boundary.
+        wave_length: Length of the sine wave either side of the boundary.
+        margin:      Extra samples either side of the boundary window.
+        block_len:   Length of the head and each random block.
+        tail:        1 to read and check the whole capture.
+        blocks:      Number of random blocks.
     """
+    if tail == 1:
+        return np.array([(0, total_len)], dtype=np.int64)
+    rng = np.random.default_rng() if rng is None else rng
+    windows = [(0, block_len), (pre - wave_length - margin, pre + wave_length + margin)]
+    windows = np.clip(np.array(windows, dtype=np.int64), 0, total_len)
+
+    span = int(np.max(windows[:, 1]))
+    nblocks = span // block_len
+    if blocks > 0 and nblocks > 0:
+        starts = rng.choice(nblocks, size=min(blocks, nblocks), replace=False) * block_len
+        windows = np.concatenate((windows, np.column_stack((starts, np.minimum(starts + block_len, span)))))
+
+    windows = windows[np.argsort(windows[:, 0])]
+    stops = np.maximum.accumulate(windows[:, 1])
+    new = np.concatenate(([True], windows[1:, 0] > stops[:-1]))
+    ends = np.append(np.flatnonzero(new)[1:] - 1, windows.shape[0] - 1)
+    return np.column_stack((windows[new, 0], stops[ends]))
+
+
+def print_window_coverage(windows, total_len):
+    # How much of the capture the windows check, and what they leave out.
+    checked = int(np.sum(windows[:, 1] - windows[:, 0]))
+    read = int(windows[-1, 1])
+    print("Offload windows check {} of {} samples ({:.1f}%).".format(checked, total_len, 100 * checked / total_len))
+    if read < total_len:
+        print("Samples {} to {} ({:.1f}%) are not checked, --offload_tail=1 checks the whole capture.".format(
+            read, total_len, 100 * (total_len - read) / total_len))
+    return None
 
-    # create a linear spacing between 0 and 0.5 * pi, where the
-    # number of samples is the size of the parameter sin_len.
-    x = np.linspace(0, 2 * np.pi, 20000)
-    y = np.sin(x)
 
-    # Create an array of zeros of size final_len so we can insert
-    # the relevant data into it.
-    y2 = np.zeros(final_len)
+def get_window_rows(windows):
+    """
+    Returns the sample index of every row in a set of merged windows.
+    """
+    mask = np.zeros(int(windows[-1, 1]), dtype=bool)
+    for start, stop in windows:
+        mask[start:stop] = True
+    return np.flatnonzero(mask)
 
-    es = np.array([np.nan]*es_len)
 
-    # Make a list of fractions of a full sine wave.
-    pattern = [0.25, 0.75, 0.25, 0.75, 1]
-    pos = 0
 
-    for num, val in enumerate(pattern):
+def parse_stl(stl):
+    """
+    Parses a GPG STL into two arrays: the time (in clocks) of each line and
+    the output state set at that time (the state is written in hex).
+    """
+    rows = [line.strip().split(",") for line in stl.splitlines()
+            if line.strip() and not line.strip().startswith("#")]
+    times = np.array([int(row[0]) for row in rows], dtype=np.int64)
+    states = np.array([int(row[1], 16) for row in rows], dtype=np.int64)
+    return times, states
 
-        # Loop over each burst, insert NaN(s) for the event sample
-        # and insert a sine wave chunk proportional to the size of the pattern.
-        arr_section = np.concatenate((es, y[0:int(val*y.shape[-1])]))
 
-        y2[pos:pos+arr_section.shape[-1]] = arr_section #np.concatenate((es, y))
+STL_OPEN = np.iinfo(np.int64).max
 
-        pos = pos + arr_section.shape[-1]
-    return y2
 
+def get_stl_gates(stl, bit=0):
+    """
+    Returns the start and stop times of every interval where the chosen GPG
+    output bit is high. The GPG output is low before the first line of the
+    STL. A gate that is still open at the end of the STL has a stop time of
+    STL_OPEN.
+    """
+    times, states = parse_stl(stl)
+    level = (states >> bit) & 1
+    edges = np.diff(np.concatenate(([0], level)))
+    starts = times[edges == 1]
+    stops = times[edges == -1]
+    if stops.shape[-1] < starts.shape[-1]:
+        stops = np.append(stops, STL_OPEN)
+    return starts, stops
+
+
+# The rgm STL (create_rgm_stl) opens its first gate for 5005 clocks, where the
+# other gates are exactly as long as their bursts: the UUT only starts
+# sampling the gate 5 clocks after the GPG starts. With it, the first burst is
+# 5000 samples and the ES are at 0, 5001, 20002, 25003, 40004.
+RGM_GPG_START = 5
 
-def get_ideal_rtm_data(final_len=50000, sin_len=5000, es_len=1):
+
+@functools.lru_cache(maxsize=16)
+def get_stl_model(stl, final_len, mode="rgm", edge=1, bit=0, translen=5000, es_len=1, start=0):
     """
+    Builds the timeline of a capture driven by a GPG STL. The result is
+    cached, so the model is only built once per plan step.
+
     Parameter descriptions:
-        final_len:    Length of the full rtm data.
-        sin_len:      Length of each rtm_translen sized block.
-        es_len:       Number of samples in the ES.
+        stl:       The STL loaded into the GPG.
+        final_len: Length of the capture in samples.
+        mode:      "rgm" takes a sample every clock while the gate is high.
+                   "rtm" takes translen samples after each event edge.
+        edge:      Which edge is the event in rtm mode (1 rising, 0 falling).
+        bit:       The GPG output bit that drives the gate / event.
+        translen:  RTM_TRANSLEN.
+        es_len:    Number of samples in the ES.
+        start:     Clocks between the GPG starting and the UUT seeing its
+                   output (see RGM_GPG_START). Source clocks are counted
+                   from there, and anything in the STL before it is lost.
+
+    Returns a dict containing:
+        times:        The source clock of each sample in the capture. ES
+                      samples, and samples past the end of the STL, are -1.
+        es_positions: The index of each ES in the capture.
+        bursts:       The source clock and length of each burst.
+        gate_mask:    One bool per source clock, True if it was sampled.
+    """
+    starts, stops = get_stl_gates(stl, bit)
+    stops = np.where(stops == STL_OPEN, STL_OPEN, stops - start)
+    starts = np.maximum(starts - start, 0)[stops > 0]
+    stops = stops[stops > 0]
+    if mode == "rtm":
+        starts = starts if edge == 1 else stops[stops != STL_OPEN]
+        lengths = np.full(starts.shape, translen, dtype=np.int64)
+    else:
+        lengths = np.minimum(stops - starts, final_len)
+
+    # Only keep as many bursts as it takes to fill the capture.
+    seg_len = lengths + es_len
+    seg_end = np.cumsum(seg_len)
+    nburst = min(int(np.searchsorted(seg_end, final_len)) + 1, seg_len.shape[-1])
+    starts = starts[:nburst]
+    lengths = lengths[:nburst]
+    seg_len = seg_len[:nburst]
+    seg_start = seg_end[:nburst] - seg_len
+
+    burst = np.repeat(np.arange(nburst), seg_len)[:final_len]
+    offset = np.arange(burst.shape[-1]) - seg_start[burst]
+    times = np.full(final_len, -1, dtype=np.int64)
+    times[:burst.shape[-1]] = np.where(offset < es_len, -1, starts[burst] + offset - es_len)
+
+    gate_mask = np.zeros(int(times.max()) + 1, dtype=bool)
+    gate_mask[times[times >= 0]] = True
+
+    model = {
+        "times": times,
+        "es_positions": seg_start[seg_start < final_len],
+        "bursts": np.column_stack((starts, lengths)),
+        "gate_mask": gate_mask,
+    }
+    for item in model.values():
+        item.setflags(write=False)
+    return model
+
+
+def get_test_stl_model(test, event, stl, final_len, es_len=1, translen=5000):
+    """
+    Returns the STL model for a GPG driven test, or None if the test does not
+    use the GPG.
+    """
+    if test == "rgm":
+        return get_stl_model(stl, final_len, mode="rgm", es_len=es_len, start=RGM_GPG_START)
+    elif test == "rtm_gpg":
+        return get_stl_model(stl, final_len, mode="rtm", edge=event[2], translen=translen, es_len=es_len)
+    return None
+
+
+def get_ideal_rgm_data(stl, final_len=75000, es_len=1, wave_length=20000, cycles=5, start=RGM_GPG_START):
     """
-    # create a linear spacing between 0 and 0.5 * pi, where the
-    # number of samples is the size of the parameter sin_len.
-    x = np.linspace(0, 0.5 * np.pi, sin_len)
+    Parameter descriptions:
+        stl:         The STL loaded into the GPG.
+        final_len:   Length of the full rgm data.
+        es_len:      Number of samples in the ES.
+        wave_length: Length of one sine wave in samples (the clock divisor).
+        cycles:      Number of sine waves in the sig gen burst.
+        start:       GPG start latency in clocks (see RGM_GPG_START).
+    """
+    model = get_stl_model(stl, final_len, mode="rgm", es_len=es_len, start=start)
+    times = model["times"]
+    valid = times >= 0
+
+    # The sig gen bursts a number of whole sine waves and is then flat. Each
+    # sample in the capture is the burst at the source clock it was taken on.
+    y = np.sin(2 * np.pi * times[valid] / wave_length)
+    y[times[valid] >= cycles * wave_length] = 0
 
-    y = np.sin(x)
+    y2 = np.full(final_len, np.nan)
+    y2[valid] = y
+    return y2
 
-    # Create an array of zeros of size final_len so we can insert
-    # the relevant data into it.
-    y2 = np.zeros(final_len)
 
-    es = np.array([np.nan]*es_len)
+def get_ideal_rtm_gpg_data(stl, event, final_len=50000, es_len=1, translen=5000):
+    """
+    The rtm_gpg sig gen is a free running ramp, so only the structure of the
+    capture is known. Returns NaN everywhere, which leaves the ES positions
+    to be checked against the model with check_es_positions. That needs the
+    ES in the data (demux=0): with demux=1 nothing in the data is checked.
+    """
+    return np.full(final_len, np.nan)
 
-    for num, count in enumerate(range(0, int(final_len/sin_len))):
-        # Loop over each rtm_translen section and insert NaN(s) for the event sample
-        # and insert a sine wave chunk for the samples.
-        arr_section = np.concatenate((es, y))
-        pos = num * arr_section.shape[-1]
 
-        if arr_section.shape[-1] > y2[pos:pos+sin_len].shape[-1] and num == 9:
-            arr_section = arr_section[0:y2[pos:].shape[-1]]
+@functools.lru_cache(maxsize=8)
+def get_ideal_rtm_data(final_len=50000, translen=5000, es_len=1, wave_length=20000):
+    """
+    Parameter descriptions:
+        final_len:    Length of the full rtm data.
+        translen:     Length of each rtm_translen sized block (RTM_TRANSLEN).
+        es_len:       Number of samples in the ES.
+        wave_length:  Length of one sine wave in samples (the clock divisor).
 
-        y2[pos:pos+arr_section.shape[-1]] = arr_section #np.concatenate((es, y))
+    Each event starts a burst at the beginning of a sine wave, so every block
+    is an ES followed by the first translen samples of the sine. The result
+    is cached and read only.
+    """
+    block = np.full(es_len + translen, np.nan)
+    block[es_len:] = np.sin(2 * np.pi * np.arange(translen) / wave_length)
 
+    # Repeat the block enough times to cover final_len and flatten it.
+    nblocks = -(-final_len // block.shape[-1])
+    y2 = np.tile(block, (nblocks, 1)).reshape(-1)[:final_len]
+    y2.setflags(write=False)
     return y2
 
 
-def get_soft_trg_ideal(data):
+def fit_sine(data, wave_length=None, max_points=2**14, iterations=2):
     """
-    Forms a perfect sine wave for a soft trigger run. Takes the channel data
-    as an argument so that the first zero crossing can be found, and the starting
-    position in radians can be calculated. With this info the sine wave can be
-    generated.
+    Fits data to offset + amplitude * sin(2 * pi * frequency * n + phase),
+    where n is the sample number. Returns (amplitude, frequency, phase,
+    offset), with the frequency in cycles per sample.
+
+    The peak of an FFT gives a coarse frequency, which is then refined by a
+    four parameter least squares fit. If the rough wave_length (in samples)
+    is known, long captures are decimated to about max_points samples before
+    fitting, keeping at least 16 samples per wave.
     """
-    # wave = np.zeros(len(data))
-    data = data - np.mean(data)
-    zero_crossings = np.where(np.diff(np.sign(data)))[0]
-    first_zc = zero_crossings[0]
-    crossing_pos = 0 if (data[first_zc-40] < 0 and data[first_zc+40] > 0) else np.pi
-
-    start_pos = crossing_pos - ((first_zc)/20000) * 2*np.pi
-    x = np.linspace(start_pos, start_pos + 10*np.pi, 100000)
-    y = np.sin(x)
-    return y
+    step = 1
+    if wave_length is not None:
+        step = max(1, min(data.shape[-1] // max_points, int(wave_length) // 16))
+    y = np.asarray(data[::step], dtype=np.float64)
+    n = np.arange(y.shape[-1]) * step
+
+    # Coarse estimate: FFT peak, interpolated between bins with a parabola.
+    spectrum = np.abs(np.fft.rfft(y - np.mean(y)))
+    peak = int(np.argmax(spectrum[1:])) + 1
+    delta = 0
+    if peak < spectrum.shape[-1] - 1:
+        a, b, c = np.log(spectrum[peak - 1:peak + 2] + 1e-12)
+        delta = 0.5 * (a - c) / (a - 2 * b + c) if (a - 2 * b + c) != 0 else 0
+    omega = 2 * np.pi * (peak + delta) / (y.shape[-1] * step)
+
+    # Refine: fit sin, cos and offset at omega, then correct omega too. The
+    # fit is done around the middle of the data and through the normal
+    # equations, which keeps it well conditioned and fast.
+    centre = n[-1] / 2
+    m = (n - centre) / max(centre, 1)
+    for iteration in range(iterations + 1):
+        sin_wave = np.sin(omega * centre * m)
+        cos_wave = np.cos(omega * centre * m)
+        columns = [sin_wave, cos_wave, np.ones(m.shape[-1])]
+        if iteration:
+            columns.append(m * (a * cos_wave - b * sin_wave))
+        basis = np.column_stack(columns)
+        params = np.linalg.solve(basis.T @ basis, basis.T @ y)
+        a, b, c = params[:3]
+        if iteration:
+            omega = omega + params[3] / max(centre, 1)
+
+    phase = np.arctan2(b, a) - omega * centre
+    return np.hypot(a, b), omega / (2 * np.pi), np.angle(np.exp(1j * phase)), c
+
+
+def get_soft_trg_ideal(data, wave_length=20000):
+    """
+    Forms a perfect sine wave for a soft trigger run. The frequency and phase
+    of the sig gen are unknown to the UUT, so they are fitted from the
+    channel data. The wave has scale 1 and is as long as the data.
+    """
+    amplitude, frequency, phase, offset = fit_sine(data, wave_length=wave_length)
+    return np.sin(2 * np.pi * frequency * np.arange(data.shape[-1]) + phase)
 
 
 def get_post_ideal_wave(trg, wave_length=20000, full_length=100000, data=[]):
@@ -141,7 +376,7 @@ def get_post_ideal_wave(trg, wave_length=20000, full_length=100000, data=[]):
         y2[0:wave_length] = y1
         ideal_wave = y2
     elif trg == [1,1,1]:
-        ideal_wave = get_soft_trg_ideal(data)
+        ideal_wave = get_soft_trg_ideal(data, wave_length=wave_length)
 
     return ideal_wave
 
@@ -169,30 +404,126 @@ def get_pre_post_ideal_wave(polarity=0, pre_length=50000, wave_length=20000, ful
     return y2
 
 
-def get_ideal_data(test, trg, event, data=[], es_len=1, pre=0, post=0):
+def get_ideal_data(test, trg, event, data=[], es_len=1, pre=0, post=0, stl=None, wave_length=20000, translen=5000):
     """
     Returns the ideal data for the scenario, based on the test, the trigger
-    and the event types.
+    and the event types. GPG driven tests (rgm, rtm_gpg) are modelled from
+    the STL passed in.
     """
     if test == "post":
-        ideal_data = get_post_ideal_wave(trg, data=data, full_length=data.shape[-1])
+        ideal_data = get_post_ideal_wave(trg, wave_length=wave_length, data=data, full_length=data.shape[-1])
 
     elif test == "pre_post":
         ideal_data = get_pre_post_ideal_wave(polarity=event[2], pre_length=pre, full_length=(pre+post))
 
     elif test == "rtm":
-        ideal_data = get_ideal_rtm_data(final_len=data.shape[-1], sin_len=5000, es_len=es_len)
+        ideal_data = get_ideal_rtm_data(final_len=data.shape[-1], translen=translen, es_len=es_len, wave_length=wave_length)
 
     elif test == "rgm":
-        ideal_data = get_ideal_rgm_data(final_len=data.shape[-1], es_len=es_len)
+        ideal_data = get_ideal_rgm_data(stl, final_len=data.shape[-1], es_len=es_len, wave_length=wave_length)
 
     elif test == "rtm_gpg":
-        return None
+        ideal_data = get_ideal_rtm_gpg_data(stl, event, final_len=data.shape[-1], es_len=es_len, translen=translen)
 
     ideal_data = ideal_data * 2 ** 15 if data.dtype == np.int16 else ideal_data * 2 ** 31
     return ideal_data
 
 
+# The arguments that the per channel analysis uses.
+ANALYSIS_ARGS = ("test", "trg", "event", "pre", "post", "clock_divisor", "rtm_translen", "align", "align_search")
+
+
+def get_analysis_params(args, stl=None):
+    """
+    Returns the arguments in ANALYSIS_ARGS, and the STL of the test (if the
+    GPG is used), as a namespace that can be pickled for the pool workers.
+    """
+    return argparse.Namespace(stl=stl, **{name: getattr(args, name) for name in ANALYSIS_ARGS})
+
+
+def get_channel_ideal(params, channel_data, rows=None):
+    # The ideal data for one channel of the current test. rows are the rows
+    # kept by a windowed offload, if any.
+    if params.test == "pre_post":
+        ideal_data = get_ideal_data(params.test, params.trg, params.event, data=channel_data, pre=params.pre, post=params.post)
+        return ideal_data if rows is None else ideal_data[rows]
+    return get_ideal_data(params.test, params.trg, params.event, data=channel_data, stl=params.stl,
+                          wave_length=params.clock_divisor, translen=params.rtm_translen)
+
+
+def get_max_lag(params):
+    # Searching more than half a sig gen wave out could match the wrong wave.
+    return min(params.align_search, params.clock_divisor // 2)
+
+
+@functools.lru_cache(maxsize=8)
+def get_window(length):
+    """
+    Returns a 4 term Blackman-Harris window of the given length. Windows are
+    cached and read only, so each length is only computed once.
+    """
+    x = 2 * np.pi * np.arange(length) / length
+    window = 0.35875 - 0.48829 * np.cos(x) + 0.14128 * np.cos(2 * x) - 0.01168 * np.cos(3 * x)
+    window.setflags(write=False)
+    return window
+
+
+def has_spectrum(test, trg):
+    """
+    True if the capture is a free running sine that the spectral metrics
+    make sense for: only post with a soft trigger. With a hard trigger the
+    sig gen sends a burst of 1 or 3 waves (or nothing for [1,0,0]), and the
+    other tests have a trigger step, bursts or gaps, and with demux=0 event
+    samples in the data.
+    """
+    return test == "post" and list(trg) == [1, 1, 1]
+
+
+def get_spectral_metrics(data, harmonics=5, lobe=4):
+    """
+    Returns the SNR, THD, SINAD, SFDR (all in dB) and ENOB of every channel
+    in a (samples, channels) block, using one batched rfft.
+
+    The fundamental is the largest bin in each channel. Bins within lobe of
+    DC, of the fundamental, and of each harmonic up to harmonics are counted
+    as DC, signal and distortion. Everything else is noise.
+
+    Returns a dict with one array (one value per channel) for each metric.
+    """
+    data = np.asarray(data, dtype=np.float64).reshape(data.shape[0], -1)
+    data = data - np.mean(data, axis=0)
+    power = np.abs(np.fft.rfft(data * get_window(data.shape[0])[:, None], axis=0)) ** 2
+    nbins = power.shape[0]
+    bins = np.arange(nbins)[:, None]
+
+    dc = bins <= lobe
+    fundamental = np.argmax(np.where(dc, 0, power), axis=0)
+    signal = np.abs(bins - fundamental) <= lobe
+    distortion = np.zeros(power.shape, dtype=bool)
+    for harmonic in range(2, harmonics + 2):
+        # Harmonics above Nyquist fold back into the band.
+        folded = (harmonic * fundamental) % (2 * (nbins - 1))
+        folded = np.where(folded >= nbins, 2 * (nbins - 1) - folded, folded)
+        distortion |= np.abs(bins - folded) <= lobe
+    distortion &= ~(signal | dc)
+    noise = ~(signal | distortion | dc)
+
+    tiny = np.finfo(np.float64).tiny
+    signal_power = np.sum(power * signal, axis=0) + tiny
+    distortion_power = np.sum(power * distortion, axis=0) + tiny
+    noise_power = np.sum(power * noise, axis=0) + tiny
+    spur = np.max(np.where(signal | dc, 0, power), axis=0) + tiny
+
+    sinad = 10 * np.log10(signal_power / (noise_power + distortion_power))
+    return {
+        "snr": 10 * np.log10(signal_power / noise_power),
+        "thd": 10 * np.log10(distortion_power / signal_power),
+        "sinad": sinad,
+        "sfdr": 10 * np.log10(np.max(power * signal, axis=0) / spur),
+        "enob": (sinad - 1.76) / 6.02,
+    }
+
+
 def scale_wave(real_data, ideal_data):
     """
     Returns a wave that is scaled to the max of another. This is useful for
@@ -207,6 +538,311 @@ def scale_wave(real_data, ideal_data):
     return scaled_data
 
 
+def get_full_scale(data):
+    """
+    Returns the full scale of the data type of a capture.
+    """
+    return np.iinfo(data.dtype).max if data.dtype.kind in "iu" else 1.0
+
+
+def get_residual(real_data, ideal_data):
+    """
+    Returns real_data - ideal_data for every sample where the ideal data is
+    known, as a percentage of full scale.
+    """
+    mask = ~(np.isnan(real_data) | np.isnan(ideal_data))
+    return (real_data[mask] - ideal_data[mask]) * (100 / get_full_scale(real_data))
+
+
+def min_max_decimate(data, points=2000):
+    """
+    Decimates data to at most points values for plotting, keeping the min
+    and then the max of each bin so that spikes and glitches still show.
+    Returns the sample index of each value and the values. Samples after
+    the last whole bin are dropped.
+    """
+    data = np.asarray(data)
+    factor = max(1, int(np.ceil(2 * data.shape[-1] / max(points, 2))))
+    if factor == 1:
+        return np.arange(data.shape[-1]), data
+    nbins = data.shape[-1] // factor
+    bins = data[:nbins * factor].reshape(nbins, factor)
+    values = np.column_stack((bins.min(axis=1), bins.max(axis=1))).ravel()
+    positions = (np.arange(nbins)[:, np.newaxis] * factor + [0, factor - 1]).ravel()
+    return positions, values
+
+
+def get_preview_pyramid(data, base=8, first=64, min_bins=64):
+    """
+    Returns min/max preview levels of data as {factor: (mins, maxs)}, where
+    each level keeps the min and max of every factor samples. The first
+    level is made from the data and each further level (base times coarser)
+    from the level before, so the data itself is only read once. Levels stop
+    before they would have fewer than min_bins bins.
+    """
+    data = np.asarray(data)
+    levels = {}
+    factor = first
+    nbins = data.shape[-1] // factor
+    if nbins == 0:
+        return levels
+    bins = data[:nbins * factor].reshape(nbins, factor)
+    mins, maxs = bins.min(axis=1), bins.max(axis=1)
+    while True:
+        levels[factor] = (mins, maxs)
+        nbins = mins.shape[-1] // base
+        if nbins < min_bins:
+            return levels
+        mins = mins[:nbins * base].reshape(nbins, base).min(axis=1)
+        maxs = maxs[:nbins * base].reshape(nbins, base).max(axis=1)
+        factor *= base
+
+
+def save_preview(file_path, data, **kwargs):
+    """
+    Writes the preview pyramid of data (see get_preview_pyramid) to an npz
+    file, with the length of the data.
+    """
+    arrays = {"length": np.array(data.shape[-1])}
+    for factor, (mins, maxs) in get_preview_pyramid(data, **kwargs).items():
+        arrays["min_{}".format(factor)] = mins
+        arrays["max_{}".format(factor)] = maxs
+    np.savez(file_path, **arrays)
+    return None
+
+
+def load_preview(file_path, points=2000):
+    """
+    Reads the coarsest level of a saved preview that still has at least
+    points values (or the finest level there is). Only that level is read
+    from the file. Returns the sample index of each value and the values,
+    like min_max_decimate.
+    """
+    with np.load(file_path) as preview:
+        factors = sorted(int(name[4:]) for name in preview.files if name.startswith("min_"))
+        if not factors:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        fine_enough = [factor for factor in factors if 2 * (int(preview["length"]) // factor) >= points]
+        factor = max(fine_enough) if fine_enough else factors[0]
+        mins, maxs = preview["min_{}".format(factor)], preview["max_{}".format(factor)]
+    positions = (np.arange(mins.shape[-1])[:, np.newaxis] * factor + [0, factor - 1]).ravel()
+    return positions, np.column_stack((mins, maxs)).ravel()
+
+
+def get_capture_index(data, files, es_indices=None, boundary=None, sample_counter=None, windows=None, block_rows=65536):
+    """
+    Returns the index of one UUT's saved capture as a dict, to be saved next
+    to its data files. Rows are rows of the data files; they are only
+    different from sample indices when just some windows were offloaded.
+
+    Parameter descriptions:
+        data:           The saved data, one column per channel.
+        files:          The data file of each column.
+        es_indices:     Sample index of each event sample.
+        boundary:       Sample index of the PRE/POST boundary.
+        sample_counter: The SPAD sample counter, if there is one.
+        windows:        The offload windows, or None if it was all offloaded.
+        block_rows:     Rows in each block of block_offsets.
+    """
+    rows = np.arange(data.shape[0]) if windows is None else get_window_rows(np.asarray(windows))
+    es_indices = np.zeros(0, dtype=np.int64) if es_indices is None else np.asarray(es_indices)
+    has_spad = sample_counter is not None and len(sample_counter) > 0
+    return {
+        "dtype": data.dtype.str,
+        "rows": int(data.shape[0]),
+        "files": list(files),
+        "windows": None if windows is None else np.asarray(windows).tolist(),
+        "es_indices": es_indices.tolist(),
+        "es_rows": np.searchsorted(rows, es_indices).tolist(),
+        "boundary": boundary,
+        "boundary_row": None if boundary is None else int(np.searchsorted(rows, boundary)),
+        "spad_first": int(sample_counter[0]) if has_spad else None,
+        "spad_last": int(sample_counter[-1]) if has_spad else None,
+        "block_rows": block_rows,
+        "block_offsets": (np.arange(0, data.shape[0], block_rows) * data.dtype.itemsize).tolist(),
+    }
+
+
+def open_indexed(index_path, column=0):
+    """
+    Opens a saved capture by its index (see get_capture_index). Returns the
+    index and a read only memory map of one column's data file, so that the
+    regions of interest (e.g. around index["es_rows"]) can be read without
+    reading the whole file.
+    """
+    with open(index_path) as index_file:
+        index = json.load(index_file)
+    data_path = os.path.join(os.path.dirname(index_path), index["files"][column])
+    return index, np.memmap(data_path, dtype=np.dtype(index["dtype"]), mode="r", shape=(index["rows"],))
+
+
+def get_xcorr_lags(signals, reference, max_lag=None):
+    """
+    Returns how many samples each column of signals lags reference by, to a
+    fraction of a sample, from the peaks of their FFT cross-correlations. All
+    columns are done in one batched rfft. Only lags up to max_lag are
+    searched, which stops periodic signals being matched a whole period out.
+    Both arguments should already have their mean removed.
+
+    With max_lag, the correlation at each lag is normalised by the energy of
+    both over the samples that overlap at that lag. Otherwise the shrinking
+    overlap pulls wide peaks (long sine waves) towards zero lag. Lags where
+    less than half of the data overlaps are not searched, as a few samples
+    always match. Without max_lag the raw correlation is used, so that of
+    several whole periods out the one nearest zero lag wins.
+    """
+    signals = signals.reshape(signals.shape[0], -1)
+    reference = np.asarray(reference, dtype=np.float64)
+    # Zero padding by the largest lag searched stops the correlation wrapping.
+    padding = signals.shape[0] if max_lag is None else min(int(max_lag), signals.shape[0])
+    nfft = 1 << (signals.shape[0] + padding - 1).bit_length()
+    spectra = np.fft.rfft(signals, nfft, axis=0) * np.conj(np.fft.rfft(reference, nfft))[:, None]
+    xcorr = np.fft.irfft(spectra, nfft, axis=0)
+    lags = np.fft.fftfreq(nfft, 1 / nfft).astype(np.int64)
+
+    if max_lag is None:
+        peaks = np.argmax(xcorr, axis=0)
+        return refine_peaks(xcorr, peaks, lags)
+
+    # At lag k, signals[m + k] overlaps reference[m] for m in [first, last).
+    # Only the lags searched are normalised.
+    searched = np.flatnonzero(np.abs(lags) <= max_lag)
+    first = np.clip(-lags[searched], 0, reference.shape[-1])
+    last = np.clip(np.minimum(reference.shape[-1], signals.shape[0] - lags[searched]), first, None)
+    signal_energy = np.concatenate((np.zeros((1, signals.shape[1])), np.cumsum(signals ** 2, axis=0)))
+    reference_energy = np.concatenate(([0], np.cumsum(reference ** 2)))
+    ends = np.clip(np.stack((first, last)) + lags[searched], 0, signals.shape[0]) # Clipped where nothing overlaps.
+    energy = ((signal_energy[ends[1]] - signal_energy[ends[0]]) *
+              (reference_energy[last] - reference_energy[first])[:, None])
+    usable = ((last - first) >= min(signals.shape[0], reference.shape[-1]) / 2)[:, None] & (energy > 0)
+    normalised = np.full(xcorr.shape, -np.inf)
+    normalised[searched] = np.where(usable, xcorr[searched] / np.sqrt(np.where(usable, energy, 1)), -np.inf)
+    return refine_peaks(normalised, np.argmax(normalised, axis=0), lags)
+
+
+def refine_peaks(xcorr, peaks, lags):
+    # Fit a parabola through each peak and its neighbours.
+    nfft = xcorr.shape[0]
+    columns = np.arange(xcorr.shape[1])
+    a = xcorr[peaks - 1, columns]
+    b = xcorr[peaks, columns]
+    c = xcorr[(peaks + 1) % nfft, columns]
+    curve = a - 2 * b + c
+    usable = np.isfinite(a + c) & (curve != 0)
+    delta = np.where(usable, 0.5 * (a - c) / np.where(usable, curve, 1), 0)
+    return lags[peaks] + delta
+
+
+def get_offset(real_data, ideal_data, max_lag=None, max_points=2**18, min_waves=8):
+    """
+    Returns how many samples real_data lags ideal_data by, to a fraction of a
+    sample (see get_xcorr_lags). Returns NaN if the ideal data is flat, or
+    has no ideal at all (rtm_gpg). Samples with no ideal (ES) are left out,
+    and only the part where the ideal has signal is used, as in get_uut_skew.
+    That part is cut to max_points samples from its middle, but no fewer than
+    min_waves waves, as a slow wave needs several waves for a sharp peak.
+    """
+    ideal_data = np.asarray(ideal_data, dtype=np.float64)
+    known = ~np.isnan(ideal_data)
+    if not np.any(known):
+        return np.nan
+    centred = np.where(known, ideal_data - np.mean(ideal_data[known]), 0)
+    reference = np.abs(centred)
+    active = np.flatnonzero(reference > 0.05 * np.max(reference)) if np.any(reference) else []
+    if len(active) == 0:
+        return np.nan
+
+    padding = 0 if max_lag is None else int(max_lag)
+    start = max(active[0] - padding, 0)
+    stop = min(active[-1] + padding + 1, len(ideal_data))
+    if stop - start > max_points:
+        crossings = np.flatnonzero(np.diff(np.signbit(centred[start:stop])))
+        length = stop - start
+        if len(crossings) > 2 * min_waves:
+            length = max(max_points, crossings[2 * min_waves] - crossings[0])
+        # The middle, where a fitted ideal (soft trigger) is most accurate.
+        start += (stop - start - length) // 2
+        stop = start + length
+    known = known[start:stop]
+    ideal = ideal_data[start:stop]
+    ideal = np.where(known, ideal - np.mean(ideal[known]), 0)
+    real = np.asarray(real_data[start:stop], dtype=np.float64)
+    real = np.where(known, real - np.mean(real[known]), 0)
+    return get_xcorr_lags(real, ideal, max_lag)[0]
+
+
+def get_uut_skew(channels, max_lag=None, max_points=2**17):
+    """
+    Returns the skew in samples of each UUT from the first (master) UUT, for
+    a list with the same signal from each UUT. All UUTs are correlated in one
+    batch. Only the part of the capture where the master has signal (and at
+    most max_points samples of it) is used, which keeps the FFTs short.
+    """
+    length = min(channel.shape[-1] for channel in channels)
+    reference = np.abs(channels[0][:length].astype(np.float64) - np.mean(channels[0][:length]))
+    active = np.flatnonzero(reference > 0.05 * np.max(reference)) if np.any(reference) else []
+    if len(active) == 0:
+        return np.full(len(channels), np.nan)
+
+    padding = 0 if max_lag is None else int(max_lag)
+    start = max(active[0] - padding, 0)
+    stop = min(active[-1] + padding + 1, start + max_points, length)
+    signals = np.column_stack([channel[start:stop] for channel in channels]).astype(np.float64)
+    signals -= np.mean(signals, axis=0)
+    # The master is correlated with itself too. On slow waves the peak is
+    # flat enough that it can be off zero, and the same error is in every UUT.
+    lags = get_xcorr_lags(signals, signals[:, 0], max_lag)
+    return lags - lags[0]
+
+
+def check_skew(skews, max_skew):
+    """
+    Checks that every UUT is within max_skew samples of the master. max_skew
+    of None allows any skew.
+    """
+    if max_skew is None or not np.any(np.abs(skews) > max_skew):
+        return True
+    print(CRED, "UUT skew of {} samples is more than the allowed {} samples.".format(
+        np.round(skews, 2).tolist(), max_skew), CEND)
+    return False
+
+
+def shift(data, offset):
+    """
+    Returns data delayed by offset samples (which can be fractional), using
+    linear interpolation. Samples shifted in from outside the data are NaN.
+    """
+    if np.isnan(offset):
+        return data
+    positions = np.arange(data.shape[-1]) - offset
+    return np.interp(positions, np.arange(data.shape[-1]), data, left=np.nan, right=np.nan)
+
+
+def check_jitter(offset, max_jitter):
+    """
+    Checks that the offset of a channel from its model is within max_jitter
+    samples. max_jitter of None allows any offset.
+    """
+    if max_jitter is None or np.isnan(offset) or abs(offset) <= max_jitter:
+        return True
+    print(CRED, "Offset from model of {:.2f} samples is more than the allowed {} samples.".format(
+        offset, max_jitter), CEND)
+    return False
+
+
+def is_close(real_data, ideal_data):
+    """
+    Returns True if real_data is within tolerance of ideal_data everywhere
+    that neither of them is NaN. This is the check compare makes, without
+    any printing or plotting.
+    """
+    mask = ~(np.isnan(real_data) | np.isnan(ideal_data))
+    data_type = real_data.dtype
+    tolerance = np.iinfo(data_type).max * 0.025 # 1% of max is the tolerance
+
+    return bool(np.allclose(real_data[mask], ideal_data[mask], atol=tolerance, rtol=0))
+
+
 def compare(real_data, ideal_data, test, trg, event, plot=1):
     """
 
@@ -238,46 +874,208 @@ def compare(real_data, ideal_data, test, trg, event, plot=1):
     #     plt.plot(real_data)
     #     plt.plot(ideal_data)
     #     plt.show()
-    mask = ~(np.isnan(real_data) | np.isnan(ideal_data))
-    data_type = real_data.dtype
-    tolerance = np.iinfo(data_type).max * 0.025 # 1% of max is the tolerance
-
-    comparison = np.allclose(real_data[mask], ideal_data[mask], atol=tolerance, rtol=0)
+    comparison = is_close(real_data, ideal_data)
     print("Data comparison result: {}".format(comparison))
     if not comparison and plot:
         print(CRED, "DATA COMPARISON FAILED", CEND)
-        plt.plot(real_data)
-        plt.plot(ideal_data-2000)
-        plt.grid(True)
-        plt.show()
+        import regression_visualisation # Only load matplotlib when there is something to plot.
+        regression_visualisation.plot_failure(real_data, ideal_data)
         exit(1)
     return comparison
 
 
-def check_sample_counter(sample_counter, test="pre_post"):
+def get_nan_runs(data):
+    """
+    Returns the index where each run of NaNs in data starts. In the ideal
+    rtm / rgm data these are the event samples.
+    """
+    nans = np.isnan(data)
+    return np.flatnonzero(nans & ~np.concatenate(([False], nans[:-1])))
+
+
+def split_bursts(data, es_indices, es_len=1):
+    """
+    Returns a read only (burst, sample) view of data with one row for each
+    complete burst and the ES samples dropped. No data is copied. Returns
+    None if the bursts are not evenly spaced, as they then can't be viewed
+    as a 2D array.
+    """
+    es_indices = np.asarray(es_indices, dtype=np.int64)
+    if es_indices.shape[-1] == 0:
+        return None
+    spacing = np.diff(es_indices)
+    period = spacing[0] if spacing.shape[-1] else data.shape[-1] - es_indices[0]
+    if np.any(spacing != period) or period <= es_len:
+        return None
+
+    nburst = (data.shape[-1] - es_indices[0]) // period
+    return np.lib.stride_tricks.as_strided(data[es_indices[0] + es_len:],
+                                           shape=(nburst, period - es_len),
+                                           strides=(period * data.strides[0], data.strides[0]),
+                                           writeable=False)
+
+
+def analyse_bursts(real_data, ideal_data, es_indices=None, expected_es=None, es_len=1):
+    """
+    Splits an rtm / rgm capture into bursts using the ES indices and checks
+    each burst against the matching burst in the ideal data.
+
+    Parameter descriptions:
+        real_data:   One channel of the capture.
+        ideal_data:  The ideal data for the channel, with NaN at each ES.
+        es_indices:  Where the ES were found in the capture. If None (demux=1)
+                     the ES are assumed to be where the model puts them.
+        expected_es: Where the model puts the ES. Defaults to the start of
+                     each run of NaNs in ideal_data.
+        es_len:      Number of samples in the ES.
+
+    Returns a structured array with one record per burst:
+        es_index:  Where the ES of the burst was found (-1 if missing).
+        alignment: es_index minus where the model puts the ES.
+        length:    Number of data samples in the burst.
+        expected:  Number of data samples the model expects (-1 if extra).
+        max_error: Largest difference between the burst and the model.
+        passed:    True if the burst lines up with and matches the model.
+    """
+    if expected_es is None:
+        expected_es = get_nan_runs(ideal_data)
+    expected_es = np.asarray(expected_es, dtype=np.int64)
+    es = expected_es if es_indices is None else np.asarray(es_indices, dtype=np.int64)
+    tolerance = np.iinfo(real_data.dtype).max * 0.025 if real_data.dtype.kind in "iu" else 0.025
+
+    lengths = np.diff(np.append(es, real_data.shape[-1])) - es_len
+    expected_lengths = np.diff(np.append(expected_es, ideal_data.shape[-1])) - es_len
+    common = min(es.shape[-1], expected_es.shape[-1])
+
+    bursts = np.zeros(max(es.shape[-1], expected_es.shape[-1]), dtype=[
+        ("es_index", np.int64), ("alignment", np.int64), ("length", np.int64),
+        ("expected", np.int64), ("max_error", np.float64), ("passed", bool)])
+    bursts["es_index"] = -1
+    bursts["expected"] = -1
+    bursts["max_error"] = np.inf
+    bursts["es_index"][:es.shape[-1]] = es
+    bursts["length"][:es.shape[-1]] = lengths
+    bursts["expected"][:expected_es.shape[-1]] = expected_lengths
+    bursts["alignment"][:common] = es[:common] - expected_es[:common]
+
+    # Evenly spaced bursts (rtm) are checked all at once as a 2D view.
+    done = 0
+    real_view = split_bursts(real_data, es[:common], es_len)
+    ideal_view = split_bursts(ideal_data, expected_es[:common], es_len)
+    if real_view is not None and ideal_view is not None and real_view.shape == ideal_view.shape:
+        error = np.abs(real_view - ideal_view)
+        bursts["max_error"][:error.shape[0]] = np.nan_to_num(error, copy=False).max(axis=1, initial=0)
+        done = error.shape[0]
+
+    # Any other bursts are flattened and reduced per burst.
+    overlap = np.clip(np.minimum(lengths[done:common], expected_lengths[done:common]), 0, None)
+    if overlap.sum() > 0:
+        offsets = np.arange(overlap.sum()) - np.repeat(np.cumsum(overlap) - overlap, overlap)
+        real_idx = np.repeat(es[done:common] + es_len, overlap) + offsets
+        ideal_idx = np.repeat(expected_es[done:common] + es_len, overlap) + offsets
+        error = np.nan_to_num(np.abs(real_data[real_idx] - ideal_data[ideal_idx]), copy=False)
+        nonempty = overlap > 0
+        starts = (np.cumsum(overlap) - overlap)[nonempty]
+        bursts["max_error"][done:common][nonempty] = np.maximum.reduceat(error, starts)
+        bursts["max_error"][done:common][~nonempty] = 0
+
+    bursts["passed"][:common] = ((bursts["max_error"][:common] <= tolerance)
+                                 & (bursts["alignment"][:common] == 0)
+                                 & (lengths[:common] == expected_lengths[:common]))
+    return bursts
+
+
+def print_bursts(bursts, max_lines=10):
+    """
+    Prints a summary of analyse_bursts, and the details of the first few
+    bursts that failed.
+    """
+    failed = np.flatnonzero(~bursts["passed"])
+    print("Burst analysis: {} bursts, {} passed, {} failed.".format(
+        bursts.shape[-1], bursts.shape[-1] - failed.shape[-1], failed.shape[-1]))
+    for burst in failed[:max_lines]:
+        record = bursts[burst]
+        print(CRED, "Burst {} FAILED: es_index {} alignment {} length {} expected {} max_error {:.0f}".format(
+            burst, record["es_index"], record["alignment"], record["length"],
+            record["expected"], record["max_error"]), CEND)
+    if failed.shape[-1] > max_lines:
+        print(CRED, "... and {} more.".format(failed.shape[-1] - max_lines), CEND)
+    return None
+
+
+def get_bursts_summary(bursts, max_failed=100):
+    """
+    Returns analyse_bursts as a dict that can be saved as JSON: the number of
+    bursts that passed and failed, and the details of the first max_failed
+    bursts that failed.
+    """
+    failed = np.flatnonzero(~bursts["passed"])
+    return {
+        "bursts": int(bursts.shape[-1]),
+        "passed": int(bursts.shape[-1] - failed.shape[-1]),
+        "failed": [dict(burst=int(burst), es_index=int(bursts["es_index"][burst]),
+                        alignment=int(bursts["alignment"][burst]), length=int(bursts["length"][burst]),
+                        expected=int(bursts["expected"][burst]), max_error=float(bursts["max_error"][burst]))
+                   for burst in failed[:max_failed]],
+        "nfailed": int(failed.shape[-1]),
+    }
+
+
+def check_es_positions(es_indices, model):
+    """
+    Checks that the ES indices found in the data are where the STL model says
+    they should be.
+    """
+    if model is None:
+        return True
+    es_indices = np.asarray(es_indices)
+    expected = model["es_positions"]
+    result = np.array_equal(es_indices, expected)
+    print("ES position comparison result: {}".format(result))
+    if not result:
+        print(CRED, "Expected ES at {}, found ES at {}.".format(expected.tolist(), es_indices.tolist()), CEND)
+    return result
+
+
+def get_sample_counter_gaps(sample_counter, test="pre_post", rows=None):
+    """
+    Returns (position, diff) for every step in the sample counter that isn't
+    one. The step at the PRE/POST boundary of a pre_post run is expected.
+
+    rows is the sample index of each entry when only some windows of the
+    capture were offloaded. The counter must then step by the distance
+    between rows, so the gaps between windows are checked too, and positions
+    are sample indices.
+    """
+    diffs = np.diff(np.asarray(sample_counter, dtype=np.int64))
+    expected = 1 if rows is None else np.diff(rows)
+    positions = np.flatnonzero(diffs != expected)
+    samples = positions if rows is None else rows[positions]
+    if test == "pre_post":
+        positions = positions[samples != 49999]
+        samples = samples[samples != 49999]
+    return list(zip(samples.tolist(), diffs[positions].tolist()))
+
+
+def check_sample_counter(sample_counter, test="pre_post", exit_on_fail=1, rows=None, gaps=None):
     """
     Checks that the sample counter is equal to a newly constructed array where
     each element is one greater than the last. If yes return True, else find
-    the gaps and append to a file.
+    the gaps and append to a file. Exits on any gap unless exit_on_fail is 0.
+    See get_sample_counter_gaps for rows. gaps skips the search, for gaps
+    that were already found while the data was streamed.
     """
 
-    diffs = np.diff(sample_counter)
+    diffs = np.diff(sample_counter) if gaps is None else None
     # if np.count(diffs, 1) == diffs.shape[-1]:
-    if np.all(diffs < 2):
+    if gaps is None and rows is None and np.all(diffs < 2):
         return []
     else:
-        # diffs = diffs[diffs != 1]
-        big_diffs = []
-        for pos, diff in enumerate(diffs):
-            if diff == 1:
-                continue
-            if pos == 49999 and test == "pre_post":
-                continue
-            else:
-                big_diffs.append((pos,diff))
+        big_diffs = get_sample_counter_gaps(sample_counter, test, rows) if gaps is None else gaps
         if len(big_diffs) != 0:
             print(CRED, "Discontinuities in sample counter detected: {}".format(big_diffs), CEND)
-            exit(1)
+            if exit_on_fail:
+                exit(1)
         return big_diffs
 
 
@@ -296,10 +1094,31 @@ def extract_sample_counter(data, aichan, nchan):
     return sample_counter
 
 
-def pre_post_anomaly_detect():
-    from sklearn.ensemble import IsolationForest
-    # s =
-    return None
+SHOT_FEATURES = ("residual_mean", "residual_std", "residual_max", "trigger_offset",
+                 "snr", "thd", "sfdr", "enob", "spad_gaps")
+
+
+def get_shot_features(residual, trigger_offset=np.nan, metrics=None, spad_gaps=np.nan):
+    """
+    Returns the compact feature vector that the anomaly detector scores for
+    one channel of one shot, in the order of SHOT_FEATURES. Features that are
+    not available for the shot are NaN.
+
+    Parameter descriptions:
+        residual:       get_residual for the channel.
+        trigger_offset: Offset of the trigger from the model in samples.
+        metrics:        This channel's get_spectral_metrics, as a dict.
+        spad_gaps:      Number of gaps in the sample counter.
+    """
+    metrics = {} if metrics is None else metrics
+    features = np.full(len(SHOT_FEATURES), np.nan)
+    if residual.shape[-1]:
+        features[0:3] = np.mean(residual), np.std(residual), np.max(np.abs(residual))
+    features[3] = trigger_offset
+    for num, name in enumerate(("snr", "thd", "sfdr", "enob")):
+        features[4 + num] = metrics.get(name, np.nan)
+    features[8] = spad_gaps
+    return features
 
 
 def get_agg_chans(uut):
@@ -333,15 +1152,20 @@ def size_test(test, trg, event, wave):
         return True
 
 
-def check_config(args, uut):
-
+def check_config(args, uut, exit_on_fail=1):
+    """
+    Checks that the UUT took the trigger and event. Exits if not, or returns
+    False if exit_on_fail is 0.
+    """
     # time.sleep(2)
     trg = uut.s1.trg.split(" ")[0].split("=")[1].split(",")
     trg = [ int(num) for num in trg ]
     if trg != args.trg:
         print(CYELLOW, "Trigger not taken!", CEND)
         print("Trigger is: {}, should be: {}".format(trg, args.trg))
-        exit(1)
+        if exit_on_fail:
+            exit(1)
+        return False
 
     if args.test != "post" and args.test != "rgm":
         print(args.test)
@@ -350,8 +1174,10 @@ def check_config(args, uut):
         if event != args.event:
             print(CYELLOW, "Event not taken!", CEND)
             print("Event is: {}, should be: {}".format(event, args.event))
-            exit(1)
-    return None
+            if exit_on_fail:
+                exit(1)
+            return False
+    return True
 
 
 def test_info(args, uuts):
@@ -404,6 +1230,91 @@ def test_info(args, uuts):
     return None
 
 
+ES_MAGIC = 0xaa55f154
+
+
+def get_es_records(uut, file_path="default", nchan="default", data=None):
+    """
+    Returns the event samples as a NumPy structured array.
+
+    get_es_records will pull data from a system by default (it will also
+    read in a raw datafile, or scan raw data that has already been offloaded)
+    and finds the event samples in it. There is one record per event sample
+    per aggregator site:
+
+        index: The sample index of the event sample.
+        site:  The aggregator site.
+        words: The raw words the site wrote into the event sample.
+    """
+    nchan = uut.nchan() if nchan == "default" else nchan
+    aichan = int(get_ai_channels(uut))
+
+    if data is not None:
+        data = np.ascontiguousarray(data).view(np.uint32).ravel()
+    elif file_path == "default":
+        data = np.ascontiguousarray(uut.read_muxed_data()).view(np.uint32)
+    else:
+        data = np.fromfile(file_path, dtype=np.uint32)
+
+    if int(uut.s0.data32) == 0:
+        nchan = nchan / 2 # "effective" nchan has halved if data is shorts.
+        aichan = int(aichan / 2)
+    nchan = int(nchan)
+
+    rows = data[:data.shape[-1] // nchan * nchan].reshape(-1, nchan)
+    sites = [int(site) for site in uut.get_aggregator_sites()]
+    return find_es_records(rows, sites, aichan // len(sites))
+
+
+def find_es_records(rows, sites, ll, first_row=0):
+    """
+    Returns the ES records (see get_es_records) in raw data that has been
+    viewed as uint32 and reshaped to one row per sample. first_row is the
+    sample index of the first row, for data that arrives in chunks. ll is
+    the number of uint32 words each site writes per sample.
+    """
+    indices = np.flatnonzero(rows[:, 0] == np.uint32(ES_MAGIC))
+    records = np.zeros(indices.shape[-1] * len(sites), dtype=[
+        ("index", np.int64), ("site", np.int32), ("words", np.uint32, (ll,))])
+    records["index"] = np.repeat(indices + first_row, len(sites))
+    records["site"] = np.tile(sites, indices.shape[-1])
+    records["words"] = rows[indices, :ll * len(sites)].reshape(-1, ll)
+    return records
+
+
+def get_es_positions(records):
+    """
+    Returns the sample index of each event sample in a set of ES records.
+    """
+    return np.unique(records["index"])
+
+
+def check_es_magic(records):
+    """
+    Checks that the first word from every site in every event sample has the
+    0xAA55F15X prefix. Returns the records that don't.
+    """
+    if records["words"].shape[-1] == 0:
+        return records[:0]
+    return records[records["words"][:, 0] >> 4 != ES_MAGIC >> 4]
+
+
+def format_es(records):
+    """
+    Formats ES records as hex text, for printing only. Each event sample is
+    a block with one line per word and one column per site.
+    """
+    nsites = np.unique(records["site"]).shape[-1]
+    if nsites == 0:
+        return ""
+    text = []
+    for es in records.reshape(-1, nsites):
+        for row in es["words"].T:
+            text.append("".join("0x{0:08X} ".format(word) for word in row) + "\n")
+        text.append("\n")
+    return "".join(text)
+
+
 def get_es_indices(uut, file_path="default", nchan="default", human_readable=0, return_hex_string=0):
     """
     Returns the location of event samples.
@@ -423,64 +1334,34 @@ def get_es_indices(uut, file_path="default", nchan="default", human_readable=0,
 
     Data returned by the function looks like:
     [  [Event sample indices], [Event sample data]  ]
-    """
-    # a function that return the location of event samples.
-    # returns:
-    # [ [event sample indices], [ [event sample 1], ...[event sample N] ] ]
-    indices = []
-    event_samples = []
-    nchan = uut.nchan() if nchan == "default" else nchan
-    aichan = int(get_ai_channels(uut))
 
-    if file_path == "default":
-        data = uut.read_muxed_data()
-        data = np.array(data)
-        data = np.frombuffer(data.tobytes(), dtype=np.uint32)
+    New code should use get_es_records, which keeps the event samples as
+    numbers.
+    """
+    records = get_es_records(uut, file_path=file_path, nchan=nchan)
+    indices = get_es_positions(records).tolist()
+    if len(indices) == 0:
+        return [[], "" if human_readable == 1 and return_hex_string == 1 else []]
+    nsites = np.unique(records["site"]).shape[-1]
+    words = records["words"].reshape(len(indices), nsites, -1)
+
+    if human_readable == 1 and return_hex_string == 1:
+        event_samples = format_es(records)
+    elif human_readable == 1:
+        event_samples = [[["0x{0:08X}".format(word) for word in site] for site in es] for es in words]
     else:
-        data = np.fromfile(file_path, dtype=np.uint32)
-
-    if int(uut.s0.data32) == 0:
-        nchan = nchan / 2 # "effective" nchan has halved if data is shorts.
-        aichan = int(aichan / 2)
-    nchan = int(nchan)
-    for index, sample in enumerate(data[0::nchan]):
-        # if sample == np.int32(0xaa55f154): # aa55
-        if sample == np.uint32(0xaa55f154): # aa55
-            indices.append(index)
-            event_samples.append(data[index*nchan:index*nchan + aichan])
-
-
-    if human_readable == 1:
-        # Change decimal to hex.
-        ii = 0
-        while ii < len(event_samples):
-            if type(event_samples[ii]) == np.ndarray:
-                event_samples[ii] = event_samples[ii].tolist()
-            for indice, channel in enumerate(event_samples[ii]):
-                event_samples[ii][indice] = '0x{0:08X}'.format(channel)
-            ll = int(int(len(event_samples[ii]))/int(len(uut.get_aggregator_sites())))
-            event_samples[ii] = [event_samples[ii][i:i + ll] for i in range(0, len(event_samples[ii]), ll)]
-            ii += 1
-
-        if return_hex_string == 1:
-            # Make a single string containing the hex values.
-            es_string = ""
-            for num, sample in enumerate(event_samples):
-                for i in range(len(sample[0])):
-                    for x in event_samples[num]:
-                        es_string = es_string + str(x[i]) + " "
-                    es_string = es_string + "\n"
-                es_string = es_string + "\n"
-            event_samples = es_string
+        event_samples = list(words.reshape(len(indices), -1))
 
     return [indices, event_samples]
 
 
+@functools.lru_cache(maxsize=None)
 def get_ai_channels(uut):
     """
     Returns all of the AI channels. This is a more robust way to get the
     total number of AI channels, as sometimes nchan can be set to include
-    the scratch pad.
+    the scratch pad. The sites can't change while the UUT is up, so this is
+    cached per UUT object.
     """
     ai_channels = 0
     site_types = get_site_types(uut)
@@ -491,6 +1372,7 @@ def get_ai_channels(uut):
     return ai_channels
 
 
+@functools.lru_cache(maxsize=None)
 def get_site_types(uut):
     """
     Returns a dictionary with keys AISITES, AOSITES, and DIOSITES with the
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Compares the performance of two or more FPGA / software builds from the
+results tree. The results of each build are under
+results/{MODEL}/{FPGA}/{HN_date}/{step}/ (see create_results_dir), and every
+iteration writes a timing record (the time of each phase and the offload
+rate) and its spectral metrics to {test}_results.jsonl.
+
+The first build is the baseline. For every step and quantity, the change in
+the mean from the baseline is given with a bootstrap confidence interval. A
+change is significant if the interval does not include zero. Exits with 1 if
+any build is significantly worse than the baseline by more than --threshold,
+so a firmware change that makes offload 20% slower is caught automatically.
+
+Usage:
+
+./regression_compare_builds.py results/ACQ480FMC/ACQ2106_TOP_08_ff_64B results/ACQ480FMC/ACQ2106_TOP_09_ff_64B
+
+./regression_compare_builds.py --results=./results --model=ACQ480FMC
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+
+# For each quantity, True if a bigger value is better.
+HIGHER_IS_BETTER = {"offload_mb_s": True, "snr": True, "sinad": True, "sfdr": True, "enob": True, "thd": False}
+
+
+def get_run_time(run):
+    """
+    Returns when a run started, from the date stamp at the end of its
+    directory name ({HN}_{yymmddHHMM}, see create_results_dir), or from the
+    directory itself if it doesn't have one.
+    """
+    match = re.search(r"_(\d{10})$", os.path.basename(run))
+    if match is not None:
+        try:
+            return datetime.datetime.strptime(match.group(1), "%y%m%d%H%M").timestamp()
+        except ValueError:
+            pass
+    return os.path.getmtime(run)
+
+
+def get_build_time(build):
+    # When the first run of a build started. New runs don't change it.
+    runs = [path for path in glob.glob(os.path.join(build, "*")) if os.path.isdir(path)]
+    return min((get_run_time(run) for run in runs), default=float("inf"))
+
+
+def get_builds(results, model):
+    # Every FPGA build directory of one mezzanine model, oldest first.
+    builds = [path for path in glob.glob(os.path.join(results, model, "*")) if os.path.isdir(path)]
+    return sorted(builds, key=lambda build: (get_build_time(build), build))
+
+
+def load_build(build):
+    """
+    Returns {(step, quantity): [values]} for every run of a build. Phase
+    times are the quantities phase:<name>, in seconds.
+    """
+    samples = {}
+    for path in glob.glob(os.path.join(build, "*", "*", "*_results.jsonl")):
+        step = os.path.basename(os.path.dirname(path))
+        with open(path) as results_file:
+            for line in results_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # A run that was killed mid write.
+                values = {}
+                if record.get("type") == "timing":
+                    values = {"phase:" + phase: seconds for phase, seconds in record["phases"].items()}
+                    values["offload_mb_s"] = record.get("offload_mb_s")
+                elif record.get("type") == "spectral":
+                    values = {name: record.get(name) for name in ("snr", "thd", "sinad", "sfdr", "enob")}
+                for quantity, value in values.items():
+                    if value is not None and np.isfinite(value):
+                        samples.setdefault((step, quantity), []).append(value)
+    return samples
+
+
+def bootstrap_delta(baseline, values, nboot=2000, confidence=0.95, rng=None, chunk_size=2**20):
+    """
+    Returns the relative change in the mean from baseline to values, and a
+    bootstrap confidence interval for it. The resamples are drawn in chunks
+    of about chunk_size samples, so long runs (spectral metrics have one
+    value per channel per iteration) don't need all of them in memory.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    baseline = np.asarray(baseline, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    chunk = max(1, chunk_size // max(baseline.shape[-1], values.shape[-1]))
+    deltas = []
+    for start in range(0, nboot, chunk):
+        count = min(chunk, nboot - start)
+        base_means = baseline[rng.integers(0, baseline.shape[-1], (count, baseline.shape[-1]))].mean(axis=1)
+        means = values[rng.integers(0, values.shape[-1], (count, values.shape[-1]))].mean(axis=1)
+        deltas.append((means - base_means) / np.abs(base_means))
+    deltas = np.concatenate(deltas)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(deltas, [tail, 100 - tail])
+    return (values.mean() - baseline.mean()) / abs(baseline.mean()), low, high
+
+
+def compare_builds(builds, min_samples=5, threshold=0.05, **kwargs):
+    """
+    Returns one dict per (build, step, quantity) that the baseline (the
+    first build) and the build both have at least min_samples of. worse is
+    True if the build is significantly worse by more than threshold.
+    """
+    baseline = load_build(builds[0])
+    rows = []
+    for build in builds[1:]:
+        samples = load_build(build)
+        for key in sorted(set(baseline) & set(samples)):
+            if len(baseline[key]) < min_samples or len(samples[key]) < min_samples:
+                continue
+            if np.mean(baseline[key]) == 0:
+                continue
+            delta, low, high = bootstrap_delta(baseline[key], samples[key], **kwargs)
+            higher_is_better = HIGHER_IS_BETTER.get(key[1], False) # Phase times: lower is better.
+            significant = low > 0 or high < 0
+            worse = significant and (delta < -threshold if higher_is_better else delta > threshold)
+            rows.append({"build": build, "step": key[0], "quantity": key[1],
+                         "baseline_mean": float(np.mean(baseline[key])), "mean": float(np.mean(samples[key])),
+                         "n_baseline": len(baseline[key]), "n": len(samples[key]),
+                         "delta": float(delta), "low": float(low), "high": float(high),
+                         "significant": bool(significant), "worse": bool(worse)})
+    return rows
+
+
+def print_report(builds, rows):
+    print("Baseline: {}".format(builds[0]))
+    for build in builds[1:]:
+        print("\n{}".format(build))
+        print("{:<24} {:<20} {:>12} {:>12} {:>8} {:>20}".format("step", "quantity", "baseline", "build", "change", "95% CI"))
+        for row in rows:
+            if row["build"] != build:
+                continue
+            flag = " WORSE" if row["worse"] else (" *" if row["significant"] else "")
+            print("{step:<24} {quantity:<20} {baseline_mean:>12.4g} {mean:>12.4g} {:>+7.1f}% [{:>+7.1f}%, {:>+7.1f}%]{}".format(
+                row["delta"] * 100, row["low"] * 100, row["high"] * 100, flag, **row))
+    print("\n* significant change, WORSE significantly worse than the baseline by more than the threshold.")
+    return None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='compare the performance of FPGA / software builds')
+
+    parser.add_argument('builds', nargs='*',
+    help="Build directories (results/{MODEL}/{FPGA}) to compare. The first is the baseline.")
+
+    parser.add_argument('--results', default="./results", type=str,
+    help="Results directory to find the builds of --model in. Default is ./results.")
+
+    parser.add_argument('--model', default=None, type=str,
+    help="Compare every build of this mezzanine model, oldest first, instead of \
+    listing the builds.")
+
+    parser.add_argument('--threshold', default=0.05, type=float,
+    help="Smallest relative change that counts as worse. Default is 0.05 (5%%).")
+
+    parser.add_argument('--min_samples', default=5, type=int,
+    help="Smallest number of iterations of a step to compare. Default is 5.")
+
+    parser.add_argument('--nboot', default=2000, type=int,
+    help="Number of bootstrap resamples. Default is 2000.")
+
+    parser.add_argument('--json', default=None, type=str,
+    help="Also write the comparison to this JSON file.")
+    return parser
+
+
+def run_main(args):
+    builds = args.builds if args.model is None else get_builds(args.results, args.model)
+    if len(builds) < 2:
+        print("Need at least two builds to compare, found: {}".format(builds))
+        return False
+
+    rows = compare_builds(builds, min_samples=args.min_samples, threshold=args.threshold, nboot=args.nboot)
+    print_report(builds, rows)
+    if args.json is not None:
+        with open(args.json, "w") as json_file:
+            json.dump({"baseline": builds[0], "rows": rows}, json_file, indent=1)
+
+    worse = [row for row in rows if row["worse"]]
+    print("{} significant regressions.".format(len(worse)))
+    return not worse
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run_main(get_parser().parse_args()) else 1)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+"""
+A long lived daemon for the acq400_regression test suite, and the thin client
+that talks to it. The daemon keeps UUT and sig gen connections, topology,
+the model caches and the analysis worker pools alive between runs, so a
+scheduler that launches many short runs back to back doesn't pay for startup
+each time. The plot renderer is only started by a run that fails.
+
+Requests go over a Unix socket. The client takes exactly the same arguments
+as regression_test_suite.py, streams the output of the run back and exits with
+its status. Runs in the daemon are always headless, and run one at a time.
+
+Usage:
+
+./regression_daemon.py --serve &
+
+./regression_daemon.py --test='pre_post' --trg='1,0,1' --event='1,0,1' \
+--sig_gen_name='sg0138' --channels=[[1]] --demux=0 acq1001_084
+
+./regression_daemon.py --stop
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+
+# In a directory that only this user can get into, so no one else can run tests.
+DEFAULT_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or "/tmp/acq400_regression-{}".format(os.getuid()),
+                              "acq400_regression.sock")
+
+
+class SocketStream:
+    # A write only text stream that sends each write to the client.
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        send(self.wfile, {"out": text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def send(wfile, message):
+    try:
+        wfile.write((json.dumps(message) + "\n").encode())
+        wfile.flush()
+    except OSError:
+        pass # The client has gone. Let the run finish anyway.
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode())
+        if request.get("stop"):
+            send(self.wfile, {"exit": 0})
+            threading.Thread(target=self.server.shutdown).start()
+            return
+
+        stream = SocketStream(self.wfile)
+        status = 0
+        with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+            try:
+                run_request(self.server, request)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                traceback.print_exc()
+                status = 1
+                # The connections may be broken, so make new ones next time.
+                clear_uuts(self.server)
+                self.server.sig_gens.clear()
+                close_pools(self.server)
+        send(self.wfile, {"exit": status})
+
+
+def run_request(server, request):
+    import regression_test_suite
+    os.chdir(request["cwd"])
+    sys.argv = ["regression_test_suite.py"] + request["argv"]
+    args = regression_test_suite.get_parser().parse_args(request["argv"])
+    args.headless = 1
+    args.uut_cache = server.uut_cache
+    args.sig_gens = server.sig_gens
+    args.pools = server.pools
+    regression_test_suite.run_main(args)
+
+
+def clear_uuts(server):
+    # The topology caches are keyed on the UUT objects, so clear them too, or
+    # they would keep the old connections alive.
+    import regression_analysis
+    import regression_setup
+    server.uut_cache.clear()
+    regression_setup.get_topology.cache_clear()
+    regression_analysis.get_ai_channels.cache_clear()
+    regression_analysis.get_site_types.cache_clear()
+
+
+def close_pools(server):
+    for pool in server.pools.values():
+        pool.close()
+    server.pools.clear()
+
+
+def check_private(directory):
+    # The socket directory must be ours, and closed to everyone else.
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        print("{} must belong to this user, with no access for anyone else (chmod 700).".format(directory))
+        sys.exit(1)
+    return None
+
+
+def serve(socket_path):
+    check_private(os.path.dirname(os.path.abspath(socket_path)))
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(socket_path, RequestHandler)
+    finally:
+        os.umask(umask)
+    server.uut_cache = {}
+    server.sig_gens = {}
+    server.pools = {} # Analysis pools by number of workers, started by the first run that uses them.
+
+    # Import everything up front, so that the first request is fast too.
+    import acq400_hapi
+    import regression_test_suite
+    print("Regression daemon listening on {}".format(socket_path))
+    try:
+        server.serve_forever()
+    finally:
+        close_pools(server)
+        server.server_close()
+        os.remove(socket_path)
+
+
+def request(socket_path, message):
+    # Sends a request to the daemon, prints its output and returns its status.
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    client.sendall((json.dumps(message) + "\n").encode())
+    status = 1
+    for line in client.makefile("rb"):
+        reply = json.loads(line.decode())
+        if "out" in reply:
+            sys.stdout.write(reply["out"])
+            sys.stdout.flush()
+        elif "exit" in reply:
+            status = reply["exit"]
+    client.close()
+    return status
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='regression test daemon', add_help=False,
+    epilog="Any other arguments are passed to regression_test_suite.py.")
+
+    parser.add_argument('--serve', action='store_true',
+    help="Start the daemon.")
+
+    parser.add_argument('--stop', action='store_true',
+    help="Stop the daemon.")
+
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, type=str,
+    help="Unix socket to serve on or connect to. Default is {}.".format(DEFAULT_SOCKET))
+    return parser
+
+
+def run_main(args, argv):
+    if args.serve:
+        serve(args.socket)
+        return 0
+    if args.stop:
+        return request(args.socket, {"stop": True})
+    return request(args.socket, {"argv": argv, "cwd": os.getcwd()})
+
+
+if __name__ == '__main__':
+    args, argv = get_parser().parse_known_args()
+    sys.exit(run_main(args, argv))
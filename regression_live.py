@@ -0,0 +1,173 @@
+"""
+This file contains the live view of the acq400_regression test suite
+(--live=1). It runs in its own process and shows the latest shot (real and
+ideal data of the first channel of the master), its residual, and the trend
+of the residual and the offset from the model over the loop.
+
+The capture loop only decimates the traces and puts them on a short queue.
+If the view has fallen behind, the shot is dropped, so the view can never
+slow the loop down. The view redraws at most fps times a second, and uses
+blitting so that only the lines are redrawn unless the axes have to change.
+"""
+
+import collections
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+
+import regression_analysis
+
+
+TRENDS = ("residual_std", "offset")
+
+
+def live_worker(shots, fps, history):
+    # Runs in the view process. matplotlib is only imported here.
+    import matplotlib.pyplot as plt
+
+    plt.ion()
+    fig, (wave_ax, residual_ax, trend_ax) = plt.subplots(3, 1, figsize=(12, 9))
+    real_line, = wave_ax.plot([], [], label="real", animated=True)
+    ideal_line, = wave_ax.plot([], [], label="ideal", animated=True)
+    residual_line, = residual_ax.plot([], [], color="tab:red", animated=True)
+    trend_ax2 = trend_ax.twinx()
+    trend_lines = {
+        "residual_std": trend_ax.plot([], [], label="residual std (% FS)", animated=True)[0],
+        "offset": trend_ax2.plot([], [], color="tab:green", label="offset (samples)", animated=True)[0],
+    }
+    title = wave_ax.text(0.01, 0.95, "", transform=wave_ax.transAxes, va="top", animated=True)
+    wave_ax.set_ylabel("codes")
+    wave_ax.legend(loc="upper right")
+    residual_ax.set_ylabel("residual (% FS)")
+    trend_ax.set_xlabel("iteration")
+    trend_ax.set_ylabel("residual std (% FS)")
+    trend_ax2.set_ylabel("offset (samples)")
+    for ax in (wave_ax, residual_ax, trend_ax):
+        ax.grid(True)
+    artists = [(wave_ax, real_line), (wave_ax, ideal_line), (wave_ax, title), (residual_ax, residual_line)]
+    artists += [(line.axes, line) for line in trend_lines.values()]
+
+    trends = {name: collections.deque(maxlen=history) for name in ("iteration",) + TRENDS}
+    shot = None
+    background = None
+    last_draw = 0
+    done = False
+    plt.show(block=False)
+
+    while not done and plt.fignum_exists(fig.number):
+        # Take everything waiting; keep the trend of every shot, but only draw the last.
+        items = []
+        try:
+            items.append(shots.get(timeout=0.05))
+            while True:
+                items.append(shots.get_nowait())
+        except queue.Empty:
+            pass
+        for item in items:
+            if item is None:
+                done = True
+                break
+            shot = item
+            trends["iteration"].append(item["iteration"])
+            for name in TRENDS:
+                trends[name].append(item[name])
+
+        if shot is None or time.time() - last_draw < 1 / fps:
+            fig.canvas.flush_events()
+            continue
+        last_draw = time.time()
+
+        real_line.set_data(shot["positions"], shot["real"])
+        ideal_line.set_data(shot["positions"], shot["ideal"])
+        residual_line.set_data(shot["residual_positions"], shot["residual"])
+        title.set_text("{} #{}".format(shot["title"], shot["iteration"]))
+        for name, line in trend_lines.items():
+            line.set_data(trends["iteration"], trends[name])
+
+        # Only redraw the axes (slow) when a line no longer fits in them.
+        rescale = background is None
+        for ax, artist in artists:
+            if artist is title:
+                continue
+            x, y = artist.get_data()
+            y = np.asarray(y, dtype=np.float64)
+            if len(x) == 0 or np.all(np.isnan(y)):
+                continue
+            xlim, ylim = ax.get_xlim(), ax.get_ylim()
+            if (np.min(x) < xlim[0] or np.max(x) > xlim[1] or
+                    np.nanmin(y) < ylim[0] or np.nanmax(y) > ylim[1]):
+                rescale = True
+        if rescale:
+            for ax in (wave_ax, residual_ax, trend_ax, trend_ax2):
+                ax.relim()
+                ax.autoscale_view()
+                ax.margins(0.05, 0.1)
+            fig.canvas.draw()
+            background = fig.canvas.copy_from_bbox(fig.bbox)
+
+        fig.canvas.restore_region(background)
+        for ax, artist in artists:
+            ax.draw_artist(artist)
+        fig.canvas.blit(fig.bbox)
+        fig.canvas.flush_events()
+
+    plt.close(fig)
+
+
+class LiveView:
+    """
+    Sends shots to the live view process. update never blocks.
+
+    Parameter descriptions:
+        fps:     Most redraws per second.
+        points:  Most points drawn per trace.
+        history: Number of shots shown in the trends.
+    """
+
+    def __init__(self, fps=5, points=4000, history=1000):
+        context = multiprocessing.get_context("spawn")
+        self.points = points
+        self.shots = context.Queue(maxsize=4)
+        self.process = context.Process(target=live_worker, args=(self.shots, fps, history), daemon=True)
+        self.process.start()
+        self.dropped = 0
+
+    def update(self, title, iteration, real_data, ideal_data, offset=np.nan):
+        if not self.process.is_alive():
+            return None # The window was closed.
+        ideal_data = np.broadcast_to(np.asarray(ideal_data, dtype=np.float64), real_data.shape)
+        positions, real = regression_analysis.min_max_decimate(real_data, self.points)
+        # The residual only has the samples where the ideal is known (not
+        # between rtm/rgm bursts), so map it back to their sample indices.
+        known = np.flatnonzero(~(np.isnan(real_data) | np.isnan(ideal_data)))
+        residual = regression_analysis.get_residual(real_data, ideal_data)
+        residual_positions, residual_values = regression_analysis.min_max_decimate(residual, self.points)
+        residual_positions = known[residual_positions]
+        shot = {
+            "title": title,
+            "iteration": iteration,
+            "positions": positions,
+            "real": real,
+            "ideal": ideal_data[positions],
+            "residual_positions": residual_positions,
+            "residual": residual_values,
+            "residual_std": float(np.std(residual)) if residual.shape[-1] else np.nan,
+            "offset": float(offset),
+        }
+        try:
+            self.shots.put_nowait(shot)
+        except queue.Full:
+            self.dropped += 1
+        return None
+
+    def close(self, timeout=5):
+        # The view draws what is queued, then closes.
+        try:
+            self.shots.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
@@ -0,0 +1,97 @@
+"""
+This file contains the memory accounting used by the acq400_regression test
+suite with --memory=1. Each phase of a test iteration records the peak
+memory that Python (and NumPy) allocated during it, and how much the RSS of
+the process grew. When a phase goes over the budget, the source lines that
+hold the most memory at the end of the phase are printed.
+"""
+
+import os
+import resource
+import tracemalloc
+
+
+MB = 1e6
+
+
+def get_rss():
+    """
+    Returns the resident set size of this process in bytes. Falls back to
+    the peak RSS where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryMonitor:
+    """
+    Splits a test iteration into phases with mark(name); each mark ends the
+    phase before it. The record of each finished phase is kept until take().
+
+    Parameter descriptions:
+        budget_mb: Peak allocation in MB that a phase may use before its
+                   top allocation sites are printed. None for no budget.
+        top:       Number of allocation sites to print.
+        frames:    Depth of the traceback kept for each allocation.
+    """
+
+    def __init__(self, budget_mb=None, top=10, frames=1):
+        self.budget_mb = budget_mb
+        self.top = top
+        self.phase = None
+        self.records = []
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def mark(self, name):
+        if self.phase is not None:
+            self.records.append(self.end_phase())
+        self.phase = name
+        if name is not None:
+            tracemalloc.reset_peak()
+            self.start_traced = tracemalloc.get_traced_memory()[0]
+            self.start_rss = get_rss()
+        return None
+
+    def end_phase(self):
+        traced, peak = tracemalloc.get_traced_memory()
+        rss = get_rss()
+        record = {
+            "phase": self.phase,
+            "peak_mb": (peak - self.start_traced) / MB,
+            "held_mb": (traced - self.start_traced) / MB,
+            "rss_mb": rss / MB,
+            "rss_delta_mb": (rss - self.start_rss) / MB,
+        }
+        if self.budget_mb is not None and record["peak_mb"] > self.budget_mb:
+            record["top"] = self.get_top()
+            print("Phase '{}' allocated {:.1f} MB at its peak, over the budget of {} MB. Largest allocations held:".format(
+                self.phase, record["peak_mb"], self.budget_mb))
+            for line in record["top"]:
+                print("    {}".format(line))
+        return record
+
+    def get_top(self):
+        # The source lines that hold the most traced memory right now.
+        statistics = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        )).statistics("lineno")
+        return ["{:.1f} MB in {} blocks at {}".format(stat.size / MB, stat.count, stat.traceback)
+                for stat in statistics[:self.top]]
+
+    def take(self):
+        """
+        Ends the current phase and returns the records of every finished phase.
+        """
+        self.mark(None)
+        records, self.records = self.records, []
+        return records
+
+    def close(self):
+        self.mark(None)
+        tracemalloc.stop()
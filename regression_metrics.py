@@ -0,0 +1,214 @@
+"""
+This file contains the live metrics of the acq400_regression test suite, for
+watching long soak runs. The metrics can be published as a Prometheus
+textfile (rewritten atomically after every iteration, for the node exporter
+textfile collector) and on a local HTTP endpoint, and are summed up in a
+status line printed at most once every few seconds.
+"""
+
+import http.server
+import os
+import threading
+import time
+
+
+PREFIX = "acq400_regression"
+
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120)
+
+
+def escape(value):
+    # Escape a Prometheus label value.
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class PhaseHistogram:
+    """
+    A Prometheus style histogram of phase latencies in seconds: a cumulative
+    count for each bucket, plus the sum and count.
+    """
+
+    def __init__(self, buckets=PHASE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for num, bucket in enumerate(self.buckets):
+            if seconds <= bucket:
+                self.counts[num] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+class Metrics:
+    """
+    The metrics of one run. Every method can be called from the test thread
+    while the HTTP endpoint renders them from its own thread.
+    """
+
+    def __init__(self, status_interval=10):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.passed = 0
+        self.failed = 0
+        self.offload_bytes = 0
+        self.offload_seconds = 0.0
+        self.last_offload_rate = 0.0
+        self.last_failure = None
+        self.step = ""
+        self.iteration = 0
+        self.loops = 0
+        self.phases = {}
+        self.durations = {}
+        self.last_offload = (0, 0.0)
+        self.phase = None
+        self.phase_start = None
+        self.status_interval = status_interval
+        self.last_status = 0
+        self.server = None
+
+    def mark(self, name):
+        # Ends the current phase (timing it) and starts the next one.
+        now = time.time()
+        with self.lock:
+            if self.phase is not None:
+                self.phases.setdefault(self.phase, PhaseHistogram()).observe(now - self.phase_start)
+                self.durations[self.phase] = self.durations.get(self.phase, 0.0) + now - self.phase_start
+            self.phase = name
+            self.phase_start = now
+
+    def offload(self, nbytes, seconds):
+        with self.lock:
+            self.offload_bytes += nbytes
+            self.offload_seconds += seconds
+            self.last_offload_rate = nbytes / seconds / 1e6 if seconds > 0 else 0.0
+            self.last_offload = (nbytes, seconds)
+
+    def take_durations(self):
+        # The seconds spent in each phase since the last call.
+        with self.lock:
+            durations, self.durations = self.durations, {}
+        return durations
+
+    def start_iteration(self, step, iteration, loops):
+        with self.lock:
+            self.durations = {}
+            self.step = step
+            self.iteration = iteration
+            self.loops = loops
+
+    def result(self, passed, reason=None):
+        with self.lock:
+            if passed:
+                self.passed += 1
+            else:
+                self.failed += 1
+                self.last_failure = {"reason": reason, "step": self.step, "iteration": self.iteration, "time": time.time()}
+
+    def get_rate(self):
+        # Iterations per hour since the start of the run.
+        hours = (time.time() - self.start) / 3600
+        return (self.passed + self.failed) / hours if hours > 0 else 0.0
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = [
+                "# HELP {}_iterations_total Test iterations run, by result.".format(PREFIX),
+                "# TYPE {}_iterations_total counter".format(PREFIX),
+                '{}_iterations_total{{result="pass"}} {}'.format(PREFIX, self.passed),
+                '{}_iterations_total{{result="fail"}} {}'.format(PREFIX, self.failed),
+                "# HELP {}_iterations_per_hour Iterations per hour since the start of the run.".format(PREFIX),
+                "# TYPE {}_iterations_per_hour gauge".format(PREFIX),
+                "{}_iterations_per_hour {:.3f}".format(PREFIX, self.get_rate()),
+                "# HELP {}_offload_bytes_total Bytes offloaded from the UUTs.".format(PREFIX),
+                "# TYPE {}_offload_bytes_total counter".format(PREFIX),
+                "{}_offload_bytes_total {}".format(PREFIX, self.offload_bytes),
+                "# HELP {}_offload_seconds_total Time spent offloading.".format(PREFIX),
+                "# TYPE {}_offload_seconds_total counter".format(PREFIX),
+                "{}_offload_seconds_total {:.6f}".format(PREFIX, self.offload_seconds),
+                "# HELP {}_offload_mbytes_per_second Offload rate of the last iteration.".format(PREFIX),
+                "# TYPE {}_offload_mbytes_per_second gauge".format(PREFIX),
+                "{}_offload_mbytes_per_second {:.3f}".format(PREFIX, self.last_offload_rate),
+                "# HELP {}_iteration Current test step and iteration.".format(PREFIX),
+                "# TYPE {}_iteration gauge".format(PREFIX),
+                '{}_iteration{{step="{}",loops="{}"}} {}'.format(PREFIX, escape(self.step), self.loops, self.iteration),
+                "# HELP {}_phase_seconds Latency of each phase of an iteration.".format(PREFIX),
+                "# TYPE {}_phase_seconds histogram".format(PREFIX),
+            ]
+            for phase, histogram in sorted(self.phases.items()):
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('{}_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(PREFIX, escape(phase), bucket, count))
+                lines.append('{}_phase_seconds_bucket{{phase="{}",le="+Inf"}} {}'.format(PREFIX, escape(phase), histogram.count))
+                lines.append('{}_phase_seconds_sum{{phase="{}"}} {:.6f}'.format(PREFIX, escape(phase), histogram.sum))
+                lines.append('{}_phase_seconds_count{{phase="{}"}} {}'.format(PREFIX, escape(phase), histogram.count))
+            if self.last_failure is not None:
+                lines += [
+                    "# HELP {}_last_failure_timestamp_seconds Time of the last failure, with its reason.".format(PREFIX),
+                    "# TYPE {}_last_failure_timestamp_seconds gauge".format(PREFIX),
+                    '{}_last_failure_timestamp_seconds{{reason="{}",step="{}",iteration="{}"}} {:.3f}'.format(
+                        PREFIX, escape(self.last_failure["reason"]), escape(self.last_failure["step"]),
+                        self.last_failure["iteration"], self.last_failure["time"]),
+                ]
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        # Written to a temporary file and renamed, so a scrape never sees half a file.
+        with open(path + ".tmp", "w") as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(path + ".tmp", path)
+        return None
+
+    def serve(self, port):
+        """
+        Serves the metrics on http://127.0.0.1:port/metrics from a daemon
+        thread.
+        """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # Don't print every scrape.
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return None
+
+    def get_status(self):
+        with self.lock:
+            failure = "none"
+            if self.last_failure is not None:
+                failure = "{} #{}: {}".format(self.last_failure["step"], self.last_failure["iteration"],
+                                              " ".join(str(self.last_failure["reason"]).split()))
+            return "{} {} {}/{} | {:.1f} it/h | offload {:.1f} MB/s | pass {} fail {} | last failure: {}".format(
+                time.strftime("%H:%M:%S"), self.step, self.iteration, self.loops, self.get_rate(),
+                self.last_offload_rate, self.passed, self.failed, failure)
+
+    def print_status(self, stream, force=False):
+        # Print the status line, at most once every status_interval seconds.
+        if force or time.time() - self.last_status >= self.status_interval:
+            self.last_status = time.time()
+            stream.write(self.get_status() + "\n")
+            stream.flush()
+        return None
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
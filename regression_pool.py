@@ -0,0 +1,136 @@
+"""
+This file contains the process pool that runs the CPU heavy per channel
+analysis of each shot (spectral metrics, alignment and compare) for the
+acq400_regression test suite, so that a stack of UUTs with many channels
+uses every core instead of one.
+
+The data of each UUT is copied once into a shared memory block, and the
+workers read their channels straight out of it. The workers write the ideal
+data of each channel into a second block, and only small results come back,
+so no sample arrays are pickled either way.
+"""
+
+import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def analyse_group(task):
+    """
+    Runs in a worker process. Analyses one group of channels of one UUT and
+    returns a dict per channel with its offset, compare result and spectral
+    metrics. The ideal data of each channel is written into the ideal block,
+    so the test loop doesn't have to work it out again.
+    """
+    import regression_analysis
+
+    block = shared_memory.SharedMemory(name=task["name"])
+    try:
+        view = np.ndarray(task["shape"], dtype=task["dtype"], buffer=block.buf)
+        data = view[:, task["columns"]] # A local copy of just this group.
+        del view
+    finally:
+        block.close()
+
+    params = task["params"]
+    rows = None
+    if task["windows"] is not None:
+        rows = regression_analysis.get_window_rows(np.array(task["windows"]))
+
+    metrics = {}
+    if regression_analysis.has_spectrum(params.test, params.trg):
+        metrics = regression_analysis.get_spectral_metrics(data)
+    ideals = np.empty(data.shape)
+    results = []
+    for num in range(data.shape[1]):
+        channel_data = data[:, num]
+        ideal_data = regression_analysis.get_channel_ideal(params, channel_data, rows)
+        ideals[:, num] = ideal_data
+        offset = regression_analysis.get_offset(channel_data, ideal_data, max_lag=regression_analysis.get_max_lag(params))
+        if params.align == 1:
+            ideal_data = regression_analysis.shift(ideal_data, offset)
+        results.append({
+            "offset": float(offset),
+            "compare": regression_analysis.is_close(channel_data, ideal_data),
+            "metrics": {name: float(values[num]) for name, values in metrics.items()},
+        })
+
+    block = shared_memory.SharedMemory(name=task["ideal_name"])
+    try:
+        np.ndarray((task["shape"][0], task["shape"][1]), dtype=np.float64, buffer=block.buf)[:, task["columns"]] = ideals
+    finally:
+        block.close()
+    return results
+
+
+class AnalysisPool:
+    """
+    A pool of worker processes for the per channel analysis. The shared
+    memory blocks of each UUT (its data and its ideal data) are kept, and
+    reused for the next shot if they are big enough.
+    """
+
+    def __init__(self, workers):
+        context = multiprocessing.get_context("spawn")
+        self.executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context)
+        self.workers = workers
+        self.blocks = {}
+
+    def get_block(self, key, nbytes):
+        # The shared memory block for key, made bigger if it has to be.
+        block = self.blocks.get(key)
+        if block is None or block.size < nbytes:
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = self.blocks[key] = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        return block
+
+    def share(self, index, data):
+        # Copy the data of UUT index into its shared memory block.
+        block = self.get_block(index, data.nbytes)
+        np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[:] = data
+        return block.name
+
+    def analyse(self, data, params, windows=None):
+        """
+        Analyses every channel of every UUT. The channels of each UUT are
+        split into groups so that there are about as many tasks as workers.
+        Returns one list per UUT with the result of each channel, in order.
+        Each result has the ideal data of its channel, before any align
+        shift, as "ideal".
+
+        Parameter descriptions:
+            data:    The data of each UUT, one column per channel.
+            params:  regression_analysis.get_analysis_params.
+            windows: The offload windows, if only some were offloaded.
+        """
+        groups = max(1, self.workers // max(len(data), 1))
+        futures = []
+        for index, data_set in enumerate(data):
+            data_set = np.ascontiguousarray(data_set)
+            name = self.share(index, data_set)
+            ideal_name = self.get_block(("ideal", index), data_set.shape[0] * data_set.shape[1] * 8).name
+            for columns in np.array_split(np.arange(data_set.shape[1]), max(1, min(groups, data_set.shape[1]))):
+                task = {"name": name, "ideal_name": ideal_name, "shape": data_set.shape, "dtype": data_set.dtype.str,
+                        "columns": columns, "params": params, "windows": None if windows is None else windows.tolist()}
+                futures.append((index, self.executor.submit(analyse_group, task)))
+
+        results = [[] for data_set in data]
+        for index, future in futures:
+            results[index] += future.result()
+        for index, data_set in enumerate(data):
+            # Copied out, as the block is written over by the next shot.
+            ideals = np.ndarray(data_set.shape, dtype=np.float64, buffer=self.blocks[("ideal", index)].buf)
+            for num, result in enumerate(results[index]):
+                result["ideal"] = ideals[:, num].copy()
+        return results
+
+    def close(self):
+        self.executor.shutdown()
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
@@ -0,0 +1,88 @@
+"""
+This file contains the sampling profiler used by the acq400_regression test
+suite with --profile=1. A background thread looks at the stack of the test
+thread every few milliseconds, while it is in one of the selected phases of
+run_test_iteration. The samples of every loop go into one set of counts, which
+is written as a report and as a collapsed stack file that flame graph tools
+(flamegraph.pl, speedscope, inferno) can read.
+
+The test thread is never interrupted, so the overhead is one stack walk per
+sample. A sample can only be taken when the test thread releases the GIL, so
+time in long NumPy calls is counted against the line after the call.
+"""
+
+import collections
+import os
+import sys
+import threading
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the thread that created it. Set phase to the name
+    of the current phase (None outside any phase). Only phases in phases are
+    sampled, or every phase if phases is None.
+    """
+
+    def __init__(self, interval=0.005, phases=None):
+        self.interval = interval
+        self.phases = phases
+        self.phase = None
+        self.thread_id = threading.get_ident()
+        self.counts = collections.Counter()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            phase = self.phase
+            if phase is None or (self.phases is not None and phase not in self.phases):
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(phase)
+            self.counts[";".join(reversed(stack))] += 1
+
+    def get_report(self, top=20):
+        """
+        Returns the report as lines of text: the samples in each phase, and
+        the functions with the most samples of their own (self) and including
+        the functions they call (total).
+        """
+        total = sum(self.counts.values())
+        phases = collections.Counter()
+        own = collections.Counter()
+        inclusive = collections.Counter()
+        for stack, count in self.counts.items():
+            frames = stack.split(";")
+            phases[frames[0]] += count
+            frames = frames[1:]
+            own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+
+        lines = ["{} samples every {:.1f} ms.".format(total, self.interval * 1000)]
+        for title, counter in (("phase", phases), ("self", own), ("total", inclusive)):
+            lines.append("")
+            lines.append("{:>8} {:>7}  {}".format("samples", "%", title if title == "phase" else "function ({})".format(title)))
+            for frame, count in counter.most_common(top):
+                lines.append("{:>8} {:>6.1f}%  {}".format(count, 100 * count / max(total, 1), frame))
+        return lines
+
+    def write(self, directory):
+        # Write profile.txt and profile.collapsed into directory.
+        with open("{}/profile.collapsed".format(directory), "w") as collapsed_file:
+            for stack, count in sorted(self.counts.items()):
+                collapsed_file.write("{} {}\n".format(stack, count))
+        with open("{}/profile.txt".format(directory), "w") as report_file:
+            report_file.write("\n".join(self.get_report(top=50)) + "\n")
+        return None
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
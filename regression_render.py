@@ -0,0 +1,62 @@
+"""
+This file contains the background plot renderer used by the acq400_regression
+test suite in headless mode. Plots are drawn to PNG files by a separate worker
+process using the Agg backend, so matplotlib never blocks the capture loop.
+"""
+
+import multiprocessing
+
+
+def render_worker(jobs):
+    # Runs in the worker process. matplotlib is only imported here.
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        try:
+            fig = plt.figure(figsize=(12, 6))
+            for label, trace in job["traces"]:
+                plt.plot(trace, label=label)
+            plt.title(job["title"])
+            plt.grid(True)
+            plt.legend()
+            fig.savefig(job["path"])
+            plt.close(fig)
+        except Exception as e:
+            print("Failed to render {}: {}".format(job["path"], e))
+
+
+class PlotRenderer:
+    """
+    Queues plots for the worker process. render returns straight away; the
+    PNG is written some time later. close waits for every queued plot.
+
+    The worker is only started by the first plot, so a run that doesn't fail
+    never pays for starting it (or for importing matplotlib).
+    """
+
+    def __init__(self):
+        self.jobs = None
+        self.process = None
+
+    def render(self, path, title, traces):
+        """
+        traces is a list of (label, array) pairs to plot on the same axes.
+        """
+        if self.process is None:
+            context = multiprocessing.get_context("spawn")
+            self.jobs = context.Queue()
+            self.process = context.Process(target=render_worker, args=(self.jobs,), daemon=True)
+            self.process.start()
+        self.jobs.put({"path": path, "title": title, "traces": traces})
+
+    def close(self, timeout=120):
+        if self.process is None:
+            return
+        self.jobs.put(None)
+        self.process.join(timeout)
+        self.process = None
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+"""
+Checks the analysis code of the regression test suite against synthetic
+captures, so it can be run without a UUT. Each check prints one line, and the
+script exits with 1 if any check fails.
+
+Usage:
+
+python3 regression_selfcheck.py
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import warnings
+
+import numpy as np
+
+import regression_analysis
+
+
+class FakeSite:
+
+    def __init__(self, **knobs):
+        self.__dict__.update(knobs)
+
+
+class FakeUut:
+    """
+    Just enough of an acq400_hapi UUT for the analysis functions: one
+    acq48x site of nchan channels, in site 1.
+    """
+
+    def __init__(self, nchan=8, data32=1):
+        self.s0 = FakeSite(data32=str(data32))
+        self.s1 = FakeSite(module_name="acq480fmc", NCHAN=str(nchan))
+        self.channels = nchan
+
+    def nchan(self):
+        return self.channels
+
+    def get_aggregator_sites(self):
+        return ["1"]
+
+
+def check_es_indices_empty():
+    # A capture with no event samples gives the same empty result as before.
+    uut = FakeUut()
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, "raw")
+        np.arange(8 * 1000, dtype=np.uint32).tofile(file_path)
+        indices, event_samples = regression_analysis.get_es_indices(uut, file_path=file_path)
+        hex_indices, hex_string = regression_analysis.get_es_indices(uut, file_path=file_path,
+                                                                     human_readable=1, return_hex_string=1)
+    return indices == [] and event_samples == [] and hex_indices == [] and hex_string == ""
+
+
+def check_rgm_model():
+    # The rgm model has the burst pattern the baseline model had: bursts of
+    # 5000, 15000, 5000 and 15000 samples, each after its ES.
+    import regression_test_suite
+
+    model = regression_analysis.get_test_stl_model("rgm", [1, 0, 1], regression_test_suite.create_rgm_stl(), 75000)
+    return (np.array_equal(model["es_positions"], [0, 5001, 20002, 25003, 40004]) and
+            np.array_equal(model["bursts"][:4, 1], [5000, 15000, 5000, 15000]))
+
+
+def check_offset_aligned_periodic():
+    # An aligned soft trigger capture measures no offset from its model, for
+    # short and long captures and waves, and a delay is measured as it is.
+    for length, wave_length in ((1148575, 20000), (100000, 20000), (1148575, 200000)):
+        real = 1000 * np.sin(2 * np.pi * np.arange(length) / wave_length + 0.3)
+        ideal = regression_analysis.get_soft_trg_ideal(real, wave_length)
+        offset = regression_analysis.get_offset(real, ideal, max_lag=1000)
+        delayed = regression_analysis.shift(real, 3.3)[1000:]
+        delay = regression_analysis.get_offset(delayed, ideal[1000:], max_lag=1000)
+        if abs(offset) > 0.05 or abs(delay - 3.3) > 0.05:
+            print("{} samples, {} sample wave: offset {:.3f}, delay of 3.3 measured as {:.3f}".format(
+                length, wave_length, offset, delay))
+            return False
+    return True
+
+
+def check_offset_aligned_rtm():
+    # An aligned rtm capture measures no offset from its model, with zeros or
+    # ES words in the event samples.
+    for translen in (5000, 1000):
+        ideal = np.array(regression_analysis.get_ideal_rtm_data(1148575, translen)) * 2 ** 30
+        real = np.nan_to_num(ideal).astype(np.int32)
+        with_es = real.copy()
+        with_es[np.isnan(ideal)] = np.uint32(0xaa55f154).view(np.int32)
+        for data in (real, with_es):
+            offset = regression_analysis.get_offset(data, ideal, max_lag=1000)
+            if abs(offset) > 0.05:
+                print("translen {}: offset {:.3f}".format(translen, offset))
+                return False
+    return True
+
+
+def check_offset_no_ideal():
+    # rtm_gpg has no ideal, so there is no offset, and no warning either.
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        offset = regression_analysis.get_offset(np.arange(1000.0), np.full(1000, np.nan), max_lag=100)
+    return bool(np.isnan(offset))
+
+
+def get_serial_analysis(data_set, params, rows=None):
+    # The per channel analysis as the test loop does it without the pool.
+    metrics = {}
+    if regression_analysis.has_spectrum(params.test, params.trg):
+        metrics = regression_analysis.get_spectral_metrics(data_set)
+    results = []
+    for num in range(data_set.shape[1]):
+        channel_data = data_set[:, num]
+        ideal_data = regression_analysis.get_channel_ideal(params, channel_data, rows)
+        offset = regression_analysis.get_offset(channel_data, ideal_data, max_lag=regression_analysis.get_max_lag(params))
+        shifted = regression_analysis.shift(ideal_data, offset) if params.align == 1 else ideal_data
+        results.append({"offset": float(offset), "compare": regression_analysis.is_close(channel_data, shifted),
+                        "metrics": {name: float(values[num]) for name, values in metrics.items()}, "ideal": ideal_data})
+    return results
+
+
+def check_pool_matches_serial():
+    # The pool gives the same results as the test loop, for every channel.
+    import regression_pool
+
+    rng = np.random.default_rng(1)
+    length = 100000
+    wave = np.sin(2 * np.pi * (np.arange(length)[:, None] - [0, 2.5, -4]) / 20000)
+    data = [(wave * 2 ** 30 + rng.normal(0, 2 ** 20, wave.shape)).astype(np.int32),
+            (wave[:, :2] * 2 ** 29).astype(np.int32)]
+    post = argparse.Namespace(test="post", trg=[1, 1, 1], event=[1, 0, 1], pre=0, post=length,
+                              clock_divisor=20000, rtm_translen=5000, align=1, align_search=1000)
+    burst = argparse.Namespace(**dict(vars(post), trg=[1, 0, 1]))
+    pre_post = argparse.Namespace(**dict(vars(post), test="pre_post", trg=[1, 0, 1], pre=50000, post=length - 50000, align=0))
+    windows = regression_analysis.get_offload_windows(length, 50000, block_len=1024, rng=rng)
+    rows = regression_analysis.get_window_rows(windows)
+
+    pool = regression_pool.AnalysisPool(2)
+    try:
+        for args, shot_windows in ((post, None), (burst, None), (pre_post, None), (pre_post, windows)):
+            params = regression_analysis.get_analysis_params(args)
+            shot = data if shot_windows is None else [data_set[rows] for data_set in data]
+            pooled = pool.analyse(shot, params, shot_windows)
+            for index, data_set in enumerate(shot):
+                serial = get_serial_analysis(data_set, params, None if shot_windows is None else rows)
+                for pooled_channel, serial_channel in zip(pooled[index], serial):
+                    if not (np.array_equal(pooled_channel["ideal"], serial_channel["ideal"], equal_nan=True) and
+                            np.array_equal(pooled_channel["offset"], serial_channel["offset"], equal_nan=True) and
+                            pooled_channel["compare"] == serial_channel["compare"] and
+                            pooled_channel["metrics"] == serial_channel["metrics"]):
+                        print("{} UUT {}: pool and serial results differ.".format(args.test, index))
+                        return False
+                    if bool(pooled_channel["metrics"]) != (args is post):
+                        print("{} {}: spectral metrics should only be worked out for a soft triggered post.".format(
+                            args.test, args.trg))
+                        return False
+    finally:
+        pool.close()
+    return True
+
+
+CHECKS = [
+    check_es_indices_empty,
+    check_rgm_model,
+    check_offset_aligned_periodic,
+    check_offset_aligned_rtm,
+    check_offset_no_ideal,
+    check_pool_matches_serial,
+]
+
+
+def run_main():
+    success = True
+    for check in CHECKS:
+        try:
+            passed = check()
+        except Exception as error:
+            print("{}: {}".format(check.__name__, error))
+            passed = False
+        print("{:<40} {}".format(check.__name__, "passed" if passed else "FAILED"))
+        success = success and passed
+    print("Self check {}.".format("passed" if success else "FAILED"))
+    return success
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run_main() else 1)
@@ -4,10 +4,17 @@ suite.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 import time
 import os
 import datetime
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def get_topology(uut):
+    # The mezzanine model, FPGA name and hostname of a UUT. These can't change
+    # while it is up, so they are only read once per UUT object.
+    return uut.s1.MODEL, uut.s0.fpga_version.split(" ")[0], uut.s0.HN
 
 
 def create_results_dir(uuts):
@@ -19,9 +26,7 @@ def create_results_dir(uuts):
     directories = []
 
     for uut in uuts:
-        mezz = uut.s1.MODEL
-        FPGA_name = uut.s0.fpga_version.split(" ")[0]
-        HN = uut.s0.HN
+        mezz, FPGA_name, HN = get_topology(uut)
         HN_date = HN + "_" + date_time
         directory = "./results/{}/{}/{}".format(mezz, FPGA_name, HN_date)
         print(directory)
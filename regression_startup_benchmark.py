@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+Checks how long the regression test suite takes to start. Each measurement is
+a fresh python process, and the best of several runs is compared with a
+budget. Exits with 1 if a budget is exceeded, or if a heavy module that should
+be imported lazily (matplotlib, multiprocessing) is loaded before the first
+knob write.
+
+Usage:
+
+python3 regression_startup_benchmark.py --runs=5 --help_budget=0.5 --knob_budget=1.0
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+LAZY_MODULES = ["matplotlib", "multiprocessing"]
+
+# Everything that is imported before reset_uut writes the first knob.
+KNOB_PATH = """
+import sys
+import regression_test_suite
+try:
+    import acq400_hapi
+except ImportError:
+    pass
+print(",".join(m for m in {} if m in sys.modules))
+""".format(LAZY_MODULES)
+
+
+def time_command(command, runs):
+    # Returns the best wall time of command over runs, and its last output.
+    best = None
+    output = ""
+    for run in range(runs):
+        start = time.time()
+        output = subprocess.run(command, cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='regression test suite startup benchmark')
+
+    parser.add_argument('--runs', default=5, type=int,
+    help="Number of runs of each measurement. The best is used. Default is 5.")
+
+    parser.add_argument('--help_budget', default=0.5, type=float,
+    help="Budget in seconds for regression_test_suite.py --help. Default is 0.5.")
+
+    parser.add_argument('--knob_budget', default=1.0, type=float,
+    help="Budget in seconds for the imports needed before the first knob write. \
+    Default is 1.0.")
+    return parser
+
+
+def run_main(args):
+    success = True
+
+    help_time, output = time_command([sys.executable, "regression_test_suite.py", "--help"], args.runs)
+    print("--help:            {:.3f} s (budget {:.3f} s)".format(help_time, args.help_budget))
+    if help_time > args.help_budget:
+        print("--help is over budget.")
+        success = False
+
+    knob_time, output = time_command([sys.executable, "-c", KNOB_PATH], args.runs)
+    print("first knob write:  {:.3f} s (budget {:.3f} s)".format(knob_time, args.knob_budget))
+    if knob_time > args.knob_budget:
+        print("Imports before the first knob write are over budget.")
+        success = False
+    if output.strip():
+        print("Loaded before the first knob write, should be lazy: {}".format(output.strip()))
+        success = False
+
+    print("Startup benchmark {}.".format("passed" if success else "FAILED"))
+    return success
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run_main(get_parser().parse_args()) else 1)
@@ -0,0 +1,186 @@
+"""
+This file contains the running statistics used to summarise long loops in the
+acq400_regression test suite. Every accumulator uses O(1) memory, however many
+loops are run.
+"""
+
+import numpy as np
+
+
+class RunningStats:
+    """
+    Running count, mean, variance, min and max (Welford). Each update can be
+    a single value or a whole array, which is merged in one step (Chan et al).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.shape[-1] == 0:
+            return
+        count = values.shape[-1]
+        mean = np.mean(values)
+        m2 = np.sum((values - mean) ** 2)
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, np.min(values))
+        self.max = max(self.max, np.max(values))
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def summary(self):
+        return {
+            "count": int(self.count),
+            "mean": float(self.mean),
+            "std": float(np.sqrt(self.variance)),
+            "min": float(self.min),
+            "max": float(self.max),
+        }
+
+
+class Histogram:
+    """
+    Fixed width histogram of absolute values. The last bin counts everything
+    at or above nbins * bin_width.
+    """
+
+    def __init__(self, bin_width, nbins):
+        self.bin_width = bin_width
+        self.counts = np.zeros(nbins + 1, dtype=np.int64)
+
+    def update(self, values):
+        values = np.abs(np.asarray(values, dtype=np.float64).ravel())
+        bins = np.minimum(values // self.bin_width, self.counts.shape[-1] - 1).astype(np.int64)
+        self.counts += np.bincount(bins, minlength=self.counts.shape[-1])
+
+    def summary(self):
+        return {"bin_width": self.bin_width, "counts": self.counts.tolist()}
+
+
+def nan_median(values):
+    """
+    Median of each column of a 2D array, ignoring NaNs (NaN if the column is
+    all NaN). Much quicker than np.nanmedian on small arrays, as NaNs sort to
+    the end of each column.
+    """
+    ordered = np.sort(values, axis=0)
+    valid = np.sum(~np.isnan(values), axis=0)
+    columns = np.arange(values.shape[1])
+    low = ordered[np.maximum(valid - 1, 0) // 2, columns]
+    high = ordered[np.maximum(valid, 1) // 2 - (valid == 0), columns]
+    return np.where(valid > 0, (low + high) / 2, np.nan)
+
+
+class AnomalyDetector:
+    """
+    Scores each shot's feature vector against a rolling window of recent
+    shots, using the median and MAD of each feature. The window is a fixed
+    size ring buffer, so nothing is ever retrained on the full history.
+
+    A shot is anomalous if any feature is more than threshold robust standard
+    deviations from the median. No shot is flagged until warmup shots have
+    been seen.
+    """
+
+    def __init__(self, nfeatures, window=256, warmup=20, threshold=6.0):
+        self.history = np.full((window, nfeatures), np.nan)
+        self.count = 0
+        self.warmup = warmup
+        self.threshold = threshold
+
+    def score(self, features):
+        """
+        Returns the robust z score of each feature (NaN if unknown).
+        """
+        if self.count < self.warmup:
+            return np.full(features.shape, np.nan)
+        history = self.history[:min(self.count, self.history.shape[0])]
+        median = nan_median(history)
+        mad = nan_median(np.abs(history - median))
+        scale = np.maximum(1.4826 * mad, 1e-6 * np.abs(median) + 1e-3)
+        return np.abs(features - median) / scale
+
+    def update(self, features):
+        self.history[self.count % self.history.shape[0]] = features
+        self.count += 1
+
+    def check(self, features):
+        """
+        Scores a shot and then adds it to the baseline. Returns the scores and
+        whether the shot is anomalous.
+        """
+        scores = self.score(features)
+        self.update(features)
+        return scores, bool(np.nanmax(scores, initial=0) > self.threshold)
+
+
+class LoopStats:
+    """
+    A set of RunningStats (and optional Histograms) keyed by
+    (uut, channel, quantity). uut and channel are None for quantities that
+    belong to the whole shot.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.histograms = {}
+        self.detectors = {}
+
+    def update(self, quantity, values, uut=None, channel=None, bin_width=None, nbins=50):
+        key = (uut, channel, quantity)
+        if key not in self.stats:
+            self.stats[key] = RunningStats()
+            if bin_width is not None:
+                self.histograms[key] = Histogram(bin_width, nbins)
+        self.stats[key].update(values)
+        if key in self.histograms:
+            self.histograms[key].update(values)
+
+    def check_anomaly(self, features, uut=None, channel=None, **kwargs):
+        """
+        Scores a shot with the AnomalyDetector for (uut, channel), and keeps
+        running stats of the worst score and the number of anomalous shots.
+        """
+        key = (uut, channel)
+        if key not in self.detectors:
+            self.detectors[key] = AnomalyDetector(features.shape[-1], **kwargs)
+        scores, anomalous = self.detectors[key].check(features)
+        if not np.all(np.isnan(scores)):
+            self.update("anomaly_score", np.nanmax(scores), uut=uut, channel=channel)
+            self.update("anomalous", int(anomalous), uut=uut, channel=channel)
+        return scores, anomalous
+
+    def summary(self, uut=None):
+        """
+        Returns the summary of every quantity for one uut (and of the whole
+        shot quantities) as a list of dicts.
+        """
+        summary = []
+        for key, stats in self.stats.items():
+            if key[0] not in (uut, None):
+                continue
+            entry = {"uut": key[0], "channel": key[1], "quantity": key[2]}
+            entry.update(stats.summary())
+            if key in self.histograms:
+                entry["histogram"] = self.histograms[key].summary()
+            summary.append(entry)
+        return summary
+
+    def print_summary(self):
+        for key, stats in self.stats.items():
+            name = " ".join(str(item) for item in key if item is not None)
+            print("{:<40} n {count:<8} mean {mean:<12.4g} std {std:<12.4g} min {min:<12.4g} max {max:<12.4g}".format(
+                name, **stats.summary()))
+        return None
@@ -0,0 +1,214 @@
+"""
+This file contains the streaming offload used by the acq400_regression test
+suite. The raw capture is read from the UUT's data port in fixed size, frame
+aligned chunks, and every chunk is passed to a set of consumers as soon as it
+arrives. The ES scan, SPAD check, compare and archive all run while the rest
+of the capture is still on the wire, so the analysis of a shot finishes
+almost as soon as the transfer does.
+
+Each consumer has update(first_row, chunk), called for every chunk in order,
+and result(), called once at the end of the capture.
+"""
+
+import socket
+
+import numpy as np
+
+import regression_analysis
+
+
+DATA0_PORT = 53000
+
+
+def stream_raw(host, nchan, data_size=2, chunk_rows=65536):
+    """
+    Reads the raw capture from a UUT and yields (first_row, chunk) pairs,
+    where chunk has one row per sample and nchan columns. Every chunk has
+    chunk_rows rows except the last. A partial sample at the end of the
+    capture is dropped.
+
+    The chunks share one buffer, so a chunk is only valid until the next one
+    is read. Consumers that keep data must copy it.
+    """
+    row_bytes = nchan * data_size
+    dtype = np.int32 if data_size == 4 else np.int16
+    buffer = bytearray(chunk_rows * row_bytes)
+    view = memoryview(buffer)
+    sock = socket.create_connection((host, DATA0_PORT))
+    try:
+        first_row = 0
+        while True:
+            filled = 0
+            while filled < len(buffer):
+                count = sock.recv_into(view[filled:])
+                if count == 0:
+                    break
+                filled += count
+            rows = filled // row_bytes
+            if rows > 0:
+                yield first_row, np.frombuffer(buffer, dtype=dtype, count=rows * nchan).reshape(rows, nchan)
+                first_row += rows
+            if filled < len(buffer):
+                break
+    finally:
+        sock.close()
+
+
+class ChannelCollector:
+    """
+    Keeps a copy of the selected columns, for the analysis that needs the
+    whole shot (alignment, spectral metrics, plots).
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.chunks = []
+
+    def update(self, first_row, chunk):
+        self.chunks.append(chunk[:, self.columns])
+
+    def result(self):
+        return np.concatenate(self.chunks) if self.chunks else np.zeros((0, self.columns.shape[-1]))
+
+
+class EsScanner:
+    """
+    Finds the event samples in each chunk. The result is the same as
+    regression_analysis.get_es_records.
+    """
+
+    def __init__(self, uut, data_size=2):
+        self.sites = [int(site) for site in uut.get_aggregator_sites()]
+        aichan = int(regression_analysis.get_ai_channels(uut))
+        aichan = aichan // 2 if data_size == 2 else aichan # the ES is made of uint32 words
+        self.ll = aichan // len(self.sites)
+        self.records = [regression_analysis.find_es_records(np.zeros((0, 1), dtype=np.uint32), self.sites, self.ll)]
+
+    def update(self, first_row, chunk):
+        rows = chunk.view(np.uint32)
+        self.records.append(regression_analysis.find_es_records(rows, self.sites, self.ll, first_row))
+
+    def result(self):
+        return np.concatenate(self.records)
+
+
+class SpadChecker:
+    """
+    Checks the continuity of the sample counter in the SPAD. The last value
+    of each chunk is carried over, so a gap across a chunk boundary is found
+    too. The result is the whole sample counter and the list of gaps, as
+    regression_analysis.get_sample_counter_gaps.
+    """
+
+    def __init__(self, aichan, nchan, test="pre_post"):
+        self.aichan = aichan
+        self.nchan = nchan
+        self.test = test
+        self.counters = []
+        self.gaps = []
+
+    def update(self, first_row, chunk):
+        counter = regression_analysis.extract_sample_counter(chunk.ravel(), self.aichan, self.nchan)
+        rows = np.arange(first_row - 1, first_row + counter.shape[-1])
+        if self.counters:
+            self.gaps += regression_analysis.get_sample_counter_gaps(
+                np.concatenate((self.counters[-1][-1:], counter)), self.test, rows)
+        else:
+            self.gaps += regression_analysis.get_sample_counter_gaps(counter, self.test, rows[1:])
+        if counter.shape[-1]:
+            self.counters.append(counter)
+
+    def result(self):
+        return (np.concatenate(self.counters) if self.counters else np.zeros(0, dtype=np.uint32)), self.gaps
+
+
+class ChunkedCompare:
+    """
+    Compares each chunk with the same rows of the ideal data, using the same
+    tolerance as regression_analysis.compare. Only usable when the ideal data
+    is known before the shot (and so without --align). The result is one
+    bool per column, and the first failing sample is kept for each column.
+    """
+
+    def __init__(self, ideal_data, columns, dtype):
+        self.ideal_data = ideal_data
+        self.columns = columns
+        self.tolerance = np.iinfo(dtype).max * 0.025
+        self.rows = 0
+        self.first_fail = np.full(columns.shape[-1], -1, dtype=np.int64)
+
+    def update(self, first_row, chunk):
+        real_data = chunk[:, self.columns]
+        ideal_data = self.ideal_data[first_row:first_row + real_data.shape[0], np.newaxis]
+        self.rows = first_row + real_data.shape[0]
+        if ideal_data.shape[0] != real_data.shape[0]:
+            return # The capture is longer than the ideal data; result() fails it.
+        bad = np.abs(real_data - ideal_data) > self.tolerance
+        failing = np.any(bad, axis=0) & (self.first_fail < 0)
+        self.first_fail[failing] = first_row + np.argmax(bad[:, failing], axis=0)
+
+    def result(self):
+        if self.rows != self.ideal_data.shape[-1]:
+            print("Data passed to this function is not the correct shape.")
+            print("Shape of real_data should be {} and is actually {}.".format(self.ideal_data.shape[-1], self.rows))
+            return [False] * self.columns.shape[-1]
+        return (self.first_fail < 0).tolist()
+
+
+class ArchiveWriter:
+    """
+    Writes each selected column to its _data.dat file as the chunks arrive.
+    The files are the same as the ones save_data writes.
+    """
+
+    def __init__(self, columns, directory, test):
+        self.columns = columns
+        self.files = [open("{}/{}_ch_{}_data.dat".format(directory, test, num+1), "wb")
+                      for num in range(columns.shape[-1])]
+
+    def update(self, first_row, chunk):
+        for num, column in enumerate(self.columns):
+            chunk[:, column].tofile(self.files[num])
+
+    def result(self):
+        for data_file in self.files:
+            data_file.close()
+        return None
+
+
+def get_data(uuts, args, channels, directories, ideal_data=None, chunk_rows=65536):
+    """
+    Streams the raw capture from every UUT through the consumers. Returns
+    data, events and sample_counter like regression_analysis.get_data, plus
+    one dict per UUT with the SPAD gaps and the compare result of each
+    channel (None if the ideal data was not known up front). The channel
+    data files are written as the data arrives.
+    """
+    data = []
+    events = []
+    sample_counter = []
+    results = []
+    data_size = 4 if uuts[0].s0.data32 == '1' else 2
+    dtype = np.int32 if data_size == 4 else np.int16
+
+    for index, uut in enumerate(uuts):
+        columns = np.array(channels[index]) - 1
+        collector = ChannelCollector(columns)
+        scanner = EsScanner(uut, data_size)
+        spad = SpadChecker(regression_analysis.get_agg_chans(uut), uut.nchan(), args.test)
+        consumers = [collector, scanner, spad, ArchiveWriter(columns, directories[index], args.test)]
+        if ideal_data is not None:
+            consumers.append(ChunkedCompare(ideal_data, columns, dtype))
+
+        for first_row, chunk in stream_raw(uut.uut, int(uut.s0.NCHAN), data_size, chunk_rows):
+            for consumer in consumers:
+                consumer.update(first_row, chunk)
+
+        data.append(collector.result())
+        events.append(scanner.result())
+        counter, gaps = spad.result()
+        sample_counter.append(counter)
+        consumers[3].result()
+        results.append({"spad_gaps": gaps, "compare": consumers[4].result() if ideal_data is not None else None})
+
+    return data, events, sample_counter, results
@@ -22,24 +22,44 @@ python3 regression_test_suite.py --test='pre_post' --trg='all' --event='1,0,1' \
 """
 
 from __future__ import print_function
-import acq400_hapi
 import numpy as np
 import os
 import time
 import argparse
 import socket
-import matplotlib.pyplot as plt
+import select
 import sys
 import regression_analysis
 import regression_setup
-import regression_visualisation
+import regression_stats
 import re
+import json
+import functools
+import pickle
+import contextlib
+import io
+
+# acq400_hapi, regression_visualisation (matplotlib) and regression_render
+# (multiprocessing) are imported where they are first needed, so that --help
+# and the first knob write don't wait for them.
 
 
 import logging
 mpl_logger = logging.getLogger('matplotlib')
 mpl_logger.setLevel(logging.WARNING)
 
+def timing(func):
+    # acq400_hapi.timing, but acq400_hapi is only imported on the first call.
+    timed = {}
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if "func" not in timed:
+            import acq400_hapi
+            timed["func"] = acq400_hapi.timing(func)
+        return timed["func"](*args, **kwargs)
+    return wrapper
+
+
 def create_rtm_stl():
     stl =  "0,f\n \
     10000,0\n \
@@ -89,6 +109,15 @@ def create_rgm_stl():
     return stl
 
 
+def get_stl(args):
+    # The STL that config_gpg loads for this test, or None if the GPG is unused.
+    if args.test == "rgm":
+        return create_rgm_stl()
+    elif args.test == "rtm_gpg":
+        return create_rtm_stl()
+    return None
+
+
 import enum
 class AnsiCol(enum.Enum):
     CRED = "\x1b[1;31m"
@@ -103,12 +132,16 @@ class AnsiCol(enum.Enum):
         return str(self)+other
 
 
+def get_sample_rate(args, uut):
+    # The sample rate of the uut in Hz.
+    if args.is_43X:
+        return int(float(uut.s1.ACQ43X_SAMPLE_RATE.split(" ")[1]))
+    return int(float(uut.s0.SIG_CLK_S1_FREQ.split(" ")[1]))
+
+
 def calculate_frequency(args, uut, divisor):
     # calculate a reasonable frequency from the clock speed of the master uut.
-    if args.is_43X:
-        clk_freq = (int(float(uut.s1.ACQ43X_SAMPLE_RATE.split(" ")[1])))
-    else:
-        clk_freq = (int(float(uut.s0.SIG_CLK_S1_FREQ.split(" ")[1])))
+    clk_freq = get_sample_rate(args, uut)
     print("\n\nSample Rate = ",clk_freq,"\n\n")
     freq = clk_freq / divisor
     if int(freq) == 0 :
@@ -130,15 +163,12 @@ def trigger_system(args, sig_gen, uut):
                                     # until "fudge_pp_event_time" after PRE samples have been captured
                                     # See commit cbd37f2082244d2cd7afa5883ff960df18adbf2f
             print("PRE = {}    POST = {}".format(args.pre, args.post))
-            olds = None
-            while True:
+            while True: # Nothing is printed in here, it delays the trigger.
                 news = (uut.statmon.get_pre(), uut.statmon.get_elapsed())
-                if olds and news != olds:
-                    print("pre {} elapsed {}".format(news[0], news[1]))
                 if news[1] > news[0]: # Elapsed is greater than PRE
                     time.sleep(args.fudge_pp_event_time) # Wait for "fudge_pp_event_time"
                     break
-                olds = news
+            print("pre {} elapsed {}".format(news[0], news[1]))
             time.sleep(0.1)
             print("FIRE!\n")
             sig_gen.send("TRIG\n".encode())
@@ -160,10 +190,7 @@ def config_gpg(uut, args, trg=1):
 
     uut.s0.gpg_mode = 3 # LOOPWAIT
 
-    if args.test == "rgm":
-        stl = create_rgm_stl()
-    else:
-        stl = create_rtm_stl()
+    stl = get_stl(args)
     try:
         uut.load_gpg(stl)
     except Exception:
@@ -226,50 +253,100 @@ def check_master_slave(args, uut):
 
 
 def check_es(events):
-    success_flag = True
-    for uut_es in events:
-        if uut_es == events[0]:
-            continue
-        else:
+    for uut_es in events[1:]:
+        if not (np.array_equal(uut_es["index"], events[0]["index"]) and
+                np.array_equal(uut_es["words"], events[0]["words"])):
             print("\nES location comparison FAILED!\n")
-            success_flag = False
             return False
-    if success_flag == True:
-        print("\nES location comparison successful!\n")
+    print("\nES location comparison successful!\n")
 
-    # import code
-    # code.interact(local=locals())
-    for index, item in enumerate(events[0][1].split("\n\n")):
-        for num, item2 in enumerate(item.split("\n")):
-            if num == 0:
-                for item3 in item2[0:-1].split(" ")[0:-1]:
-                    if not item3.startswith("0xAA55F15"):
-                        print(item3)
-                        print("Problem found in ES.")
-                        success_flag = False
-                        return success_flag
+    bad_es = regression_analysis.check_es_magic(events[0])
+    if bad_es.shape[-1] != 0:
+        print(regression_analysis.format_es(bad_es[:1]))
+        print("Problem found in ES.")
+        return False
 
-    return success_flag
+    return True
 
 
 def show_es(events, uuts):
-    uut_list = list(range(0, len(uuts)))
-    lines = [events[counter][1].splitlines() for counter in uut_list]
+    lines = [regression_analysis.format_es(uut_es).splitlines() for uut_es in events]
     for l in zip(*lines):
         print(*l, sep='')
     for event in events:
-        print("{}\n".format(event[0])) # Print indices too!
+        print("{}\n".format(regression_analysis.get_es_positions(event).tolist())) # Print indices too!
     return None
 
 
+def get_step_name(args):
+    # The name of the current (test, trg, event) step, e.g. pre_post_101_101.
+    return args.test + "_" + "".join(str(item) for item in args.trg) + "_" + "".join(str(item) for item in args.event)
+
+
+def get_test_dirs(args):
+    # The sub directory of each UUT's results directory for the current test.
+    directories = ["{}/{}".format(directory, get_step_name(args)) for directory in args.directories]
+    for directory in directories:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    return directories
+
+
+def atomic_write(path, content):
+    # Write to a temporary file and rename it, so path is never half written.
+    with open(path + ".tmp", "wb") as tmp_file:
+        tmp_file.write(content)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(path + ".tmp", path)
+    return None
+
+
+def get_checkpoint_path(directory):
+    return "{}/checkpoint.json".format(directory)
+
+
+def strip_resume(argv):
+    # The arguments without --resume=DIR or --resume DIR, to compare runs.
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == "--resume":
+            skip = True
+        elif not arg.startswith("--resume="):
+            stripped.append(arg)
+    return stripped
+
+
+def load_checkpoint(directory):
+    # Returns the checkpoint of a previous run, from its (master) run directory.
+    with open(get_checkpoint_path(directory)) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(args, stats=None):
+    # Record the progress of every step in the master run directory, and the
+    # loop statistics of the current step next to its results.
+    atomic_write(get_checkpoint_path(args.directories[0]), json.dumps(args.checkpoint, indent=1).encode())
+    if stats is not None:
+        atomic_write("{}/{}_stats.pkl".format(get_test_dirs(args)[0], args.test), pickle.dumps(stats))
+    return None
+
+
+def load_step_stats(args):
+    # The loop statistics saved by save_checkpoint for the current step, if any.
+    path = "{}/{}_stats.pkl".format(get_test_dirs(args)[0], args.test)
+    if not os.path.exists(path):
+        return regression_stats.LoopStats()
+    with open(path, "rb") as stats_file:
+        return pickle.load(stats_file)
+
+
 def save_data(uuts, data, channels, args):
 
-    directories = args.directories.copy()
-    for index, directory in enumerate(directories):
-        sub_dir = "{}/{}".format(directory, args.test + "_" + "".join(str(item) for item in args.trg) + "_" + "".join(str(item) for item in args.event))
-        directories[index] = sub_dir
-        if not os.path.exists(sub_dir):
-            os.makedirs(sub_dir)
+    directories = get_test_dirs(args)
 
     for index, uut in enumerate(uuts):
         for num, channel in enumerate(channels[index]):
@@ -277,15 +354,79 @@ def save_data(uuts, data, channels, args):
             print(directories[index])
             channel_data.tofile("{}/{}_ch_{}_data.dat".format(directories[index], args.test, num+1))
 
+    save_previews(uuts, data, channels, args)
+    return None
+
+
+def save_previews(uuts, data, channels, args):
+    # Write a min/max preview pyramid next to each channel's data file, so
+    # that many shots can be viewed without reading the full data.
+    directories = get_test_dirs(args)
+    for index, uut in enumerate(uuts):
+        for num, channel in enumerate(channels[index]):
+            regression_analysis.save_preview("{}/{}_ch_{}_preview.npz".format(directories[index], args.test, num+1),
+                                             data[index][:,num])
+    return None
+
+
+def save_index(uuts, data, channels, args, iteration, events, sample_counter):
+    # Write an index of each UUT's saved capture next to its data files, so
+    # that the ES, the PRE/POST boundary and any block can be found without
+    # reading them through.
+    directories = get_test_dirs(args)
+    for index, uut in enumerate(uuts):
+        capture_index = regression_analysis.get_capture_index(
+            data[index], ["{}_ch_{}_data.dat".format(args.test, num+1) for num in range(len(channels[index]))],
+            es_indices=regression_analysis.get_es_positions(events[index]) if events != [] else None,
+            boundary=args.pre if args.test == "pre_post" else None,
+            sample_counter=sample_counter[index] if sample_counter != [] else None,
+            windows=args.offload_windows_used)
+        capture_index.update({"test": args.test, "iteration": iteration, "uut": uut.s0.HN, "channels": channels[index]})
+        atomic_write("{}/{}_index.json".format(directories[index], args.test), json.dumps(capture_index).encode())
+    return None
+
+
+def save_results(args, index, record):
+    # Append one JSON record to the results file of the current test for UUT index.
+    directory = get_test_dirs(args)[index]
+    with open("{}/{}_results.jsonl".format(directory, args.test), "a") as results_file:
+        results_file.write(json.dumps(record) + "\n")
     return None
 
 
+def save_spectral_metrics(uuts, data, channels, args, iteration, metrics=None):
+    # Returns a list with one dict of metrics per channel for each UUT.
+    # metrics is that list, if the pool has already worked it out. The dicts
+    # are empty for captures that aren't a free running sine.
+    if not regression_analysis.has_spectrum(args.test, args.trg):
+        return [[{} for ch in channels[index]] for index in range(len(uuts))]
+    all_metrics = []
+    for index, uut in enumerate(uuts):
+        if metrics is None:
+            values = regression_analysis.get_spectral_metrics(data[index])
+            all_metrics.append([{name: float(value[num]) for name, value in values.items()} for num in range(len(channels[index]))])
+        else:
+            all_metrics.append(metrics[index])
+        for num, ch in enumerate(channels[index]):
+            record = dict(all_metrics[index][num])
+            print("CH {} SNR {snr:.1f} dB THD {thd:.1f} dB SINAD {sinad:.1f} dB SFDR {sfdr:.1f} dB ENOB {enob:.2f}".format(ch, **record))
+            record.update({"type": "spectral", "iteration": iteration, "uut": uut.s0.HN, "channel": ch})
+            save_results(args, index, record)
+    return all_metrics
+
+
 def verify_inputs(args):
     tests = ["post","pre_post", "rtm", "rtm_gpg", "rgm"]
     if args.test not in tests:
         print("Please choose from one of the following tests:")
         print(tests)
         exit(1)
+    if args.stream == 1 and (args.demux != 0 or args.offload_windows == 1):
+        print("--stream=1 needs --demux=0, and can't be used with --offload_windows=1.")
+        exit(1)
+    if args.test == "rtm_gpg" and args.demux == 1:
+        print(AnsiCol.CYELLOW + "rtm_gpg has no model of the data, only of the ES positions, which can't be \
+checked with --demux=1. Nothing in the data is checked; use --demux=0.", AnsiCol.CEND)
     return None
 
 
@@ -330,18 +471,18 @@ def configure_test_iteration(args, uut, is_master):
 
     elif args.test == "rtm":
         if is_master:
-            regression_setup.configure_rtm(uut, "master", trigger=args.trg, event=args.event)
+            regression_setup.configure_rtm(uut, "master", trigger=args.trg, event=args.event, post=args.rtm_post, rtm_translen=args.rtm_translen)
         else:
-            regression_setup.configure_rtm(uut, "slave")
+            regression_setup.configure_rtm(uut, "slave", post=args.rtm_post, rtm_translen=args.rtm_translen)
 
     elif args.test == "rtm_gpg":
         if is_master:
-            regression_setup.configure_rtm(uut, "master", trigger=args.trg, gpg=1, event=args.event)
+            regression_setup.configure_rtm(uut, "master", trigger=args.trg, gpg=1, event=args.event, post=args.rtm_post, rtm_translen=args.rtm_translen)
             if not config_gpg(uut, args, trg=0):            
                 print("Breaking out of test {} now.".format(args.test))
                 return False
         else:
-            regression_setup.configure_rtm(uut, "slave")
+            regression_setup.configure_rtm(uut, "slave", post=args.rtm_post, rtm_translen=args.rtm_translen)
 
     elif args.test == "rgm":
         if is_master:
@@ -354,19 +495,150 @@ def configure_test_iteration(args, uut, is_master):
             uut.s0.sync_role = "slave"
             regression_setup.configure_rgm(uut, "slave", post=75000)
     
-    regression_analysis.check_config(args, uut)
-    return True
+    return regression_analysis.check_config(args, uut, exit_on_fail=args.headless != 1)
+
+
+def update_loop_stats(stats, uut_name, ch, channel_data, ideal_data, metrics=None, spad_gaps=np.nan, offset=np.nan):
+    # Fold one channel of one shot into the running statistics for the loop,
+    # and flag the shot if it looks unusual compared to the previous shots.
+    residual = regression_analysis.get_residual(channel_data, ideal_data)
+    stats.update("residual_pct", residual, uut=uut_name, channel=ch, bin_width=0.1, nbins=50)
+    if not np.isnan(offset):
+        stats.update("trigger_offset", offset, uut=uut_name, channel=ch, bin_width=0.25, nbins=40)
+
+    features = regression_analysis.get_shot_features(residual, offset, metrics, spad_gaps)
+    scores, anomalous = stats.check_anomaly(features, uut=uut_name, channel=ch)
+    if anomalous:
+        worst = int(np.nanargmax(scores))
+        print(AnsiCol.CYELLOW + "Shot looks unusual: {} {} = {:.4g} (score {:.1f})".format(
+            uut_name, ch, features[worst], scores[worst]), AnsiCol.CEND)
+    return None
+
+
+def save_loop_stats(uuts, args, stats):
+    # Write the running statistics for the loop next to each UUT's results.
+    print(AnsiCol.CBLUE + "Loop statistics:", AnsiCol.CEND)
+    stats.print_summary()
+    for index, uut in enumerate(uuts):
+        with open("{}/{}_summary.json".format(get_test_dirs(args)[index], args.test), "w") as summary_file:
+            json.dump(stats.summary(uut=uut.s0.HN), summary_file, indent=1)
+    return None
 
-@acq400_hapi.timing            
-def run_test_iteration(args, uuts, iteration, sig_gen):
+
+def mark_phase(args, name):
+    # Start the next phase of run_test_iteration (None for the end of the
+    # iteration), for --memory=1 and --profile=1.
+    if args.memory_monitor is not None:
+        if name == "configure":
+            args.memory_monitor.take() # Drop anything left by an iteration that failed.
+        args.memory_monitor.mark(name)
+    if args.profiler is not None:
+        args.profiler.phase = name
+    args.metrics.mark(name)
+    return None
+
+
+def get_offload_bytes(args, uuts, data):
+    # The number of bytes read from the UUTs for a shot.
+    if args.demux == 1:
+        return sum(data_set.nbytes for data_set in data)
+    nbytes = 0
+    for index, uut in enumerate(uuts):
+        rows = data[index].shape[0] if args.offload_windows_used is None else args.offload_windows_used[-1, 1]
+        nbytes += int(rows) * uut.nchan() * data[index].dtype.itemsize
+    return nbytes
+
+
+def publish_metrics(args, force=False):
+    # Rewrite the metrics textfile, and print the status line if it's due.
+    if args.metrics_file is not None:
+        args.metrics.write_textfile(args.metrics_file)
+    args.metrics.print_status(sys.stdout, force=force)
+    return None
+
+
+@contextlib.contextmanager
+def iteration_output(args):
+    # With --quiet=1 the output of an iteration is only printed if it fails.
+    if args.quiet != 1:
+        yield
+        return
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            yield
+    except BaseException:
+        sys.stdout.write(output.getvalue())
+        raise
+
+
+def save_timing(args, iteration):
+    # Write the time spent in each phase and the offload rate of the iteration
+    # next to the results of the master, for comparing builds.
+    nbytes, seconds = args.metrics.last_offload
+    save_results(args, 0, {"type": "timing", "iteration": iteration, "phases": args.metrics.take_durations(),
+                           "offload_bytes": nbytes, "offload_seconds": seconds,
+                           "offload_mb_s": nbytes / seconds / 1e6 if seconds > 0 else None})
+    return None
+
+
+def save_memory(args, iteration, stats=None):
+    # Write the memory used by each phase of the iteration next to the results
+    # of the master, and keep running stats of the peak of each phase.
+    if args.memory_monitor is None:
+        return None
+    for record in args.memory_monitor.take():
+        save_results(args, 0, dict(record, type="memory", iteration=iteration))
+        if stats is not None:
+            stats.update("{}_peak_mb".format(record["phase"]), record["peak_mb"])
+            stats.update("{}_rss_delta_mb".format(record["phase"]), record["rss_delta_mb"])
+    return None
+
+
+class TestFailure(Exception):
+    # Raised by fail in headless mode, so the rest of the matrix can carry on.
+    pass
+
+
+def fail(args, iteration, reason, uuts=None, index=None, ch=None, traces=None, details=None):
+    """
+    Handles a failed check. By default the run stops here, as it always has.
+    In headless mode the failure is saved as a record (with any details, a
+    dict of extra fields), any traces are queued to be plotted to PNG in the
+    background, and TestFailure is raised.
+    """
+    print(AnsiCol.CRED + reason, AnsiCol.CEND)
+    args.metrics.result(False, reason)
+    if args.headless != 1:
+        print("Tests run: ", iteration)
+        publish_metrics(args, force=True)
+        exit(1)
+
+    record = {"type": "failure", "iteration": iteration, "test": args.test, "trg": args.trg,
+              "event": args.event, "uut": uuts[index].s0.HN if index is not None else None,
+              "channel": ch, "reason": reason}
+    record.update(details or {})
+    if traces is not None:
+        record["plot"] = "{}/{}_fail_{}_ch_{}.png".format(get_test_dirs(args)[index], args.test, iteration, ch)
+        args.renderer.render(record["plot"], "{} {}: {}".format(args.test, record["uut"], reason), traces)
+    save_results(args, index or 0, record)
+    args.failures.append(record)
+    raise TestFailure(reason)
+
+
+@timing            
+def run_test_iteration(args, uuts, iteration, sig_gen, stats=None):
     channels = eval(args.channels[0])
     data = []
     events = []
     sample_counter = []
     success_flag = True
+    mark_phase(args, "configure")
 
     for index, uut in reversed(list(enumerate(uuts))):
         if not configure_test_iteration(args, uut, index==0):
+            if args.headless == 1:
+                fail(args, iteration, "Configuring {} failed.".format(uut.s0.HN), uuts, index)
             break
 
         uut.s0.set_arm
@@ -376,61 +648,375 @@ def run_test_iteration(args, uuts, iteration, sig_gen):
 
         for index, uut in enumerate(uuts):
             uut.statmon.wait_stopped()
-        data, events, sample_counter = regression_analysis.get_data(uuts, args, channels)
-
+        mark_phase(args, "offload")
+        offload_start = time.time()
+        streamed = None
+        if args.stream == 1:
+            import regression_stream
+            ideal_data = None
+            if args.test == "pre_post" and args.align == 0: # Known before the shot, so compare in flight.
+                ideal_data = regression_analysis.get_ideal_data(args.test, args.trg, args.event, pre=args.pre, post=args.post,
+                                                                data=np.zeros(0, dtype=np.int32 if uuts[0].s0.data32 == '1' else np.int16))
+            data, events, sample_counter, streamed = regression_stream.get_data(uuts, args, channels, get_test_dirs(args),
+                                                                                ideal_data, chunk_rows=args.stream_chunk)
+            args.offload_windows_used = None
+        else:
+            data, events, sample_counter = regression_analysis.get_data(uuts, args, channels)
+        rows = None
+        if args.offload_windows_used is not None:
+            rows = regression_analysis.get_window_rows(args.offload_windows_used)
+            for index, uut in enumerate(uuts):
+                save_results(args, index, {"type": "offload_windows", "iteration": iteration, "uut": uut.s0.HN,
+                                           "windows": args.offload_windows_used.tolist()})
+        offload_time = time.time() - offload_start
+        args.metrics.offload(get_offload_bytes(args, uuts, data), offload_time)
+        if stats is not None:
+            stats.update("offload_time", offload_time)
+            for index, event in enumerate(events):
+                stats.update("es_count", regression_analysis.get_es_positions(event).shape[-1], uut=uuts[index].s0.HN)
+
+        mark_phase(args, "es")
         if args.demux == 0:
             if args.show_es == 1:
                 show_es(events, uuts)        
-            success_flag = check_es(events)       
-
-        save_data(uuts, data, channels, args)
+            success_flag = check_es(events)
+            for index, event in enumerate(events):
+                model = regression_analysis.get_test_stl_model(args.test, args.event, get_stl(args), data[index].shape[0], translen=args.rtm_translen)
+                if not regression_analysis.check_es_positions(regression_analysis.get_es_positions(event), model):
+                    success_flag = False
+
+        mark_phase(args, "skew")
+        if len(uuts) > 1:
+            skews = regression_analysis.get_uut_skew([data_set[:, 0] for data_set in data], max_lag=regression_analysis.get_max_lag(args))
+            print("UUT skew from master (samples): {}".format(np.round(skews, 2).tolist()))
+            for index, uut in enumerate(uuts):
+                save_results(args, index, {"type": "skew", "iteration": iteration, "uut": uut.s0.HN, "skew": float(skews[index])})
+                if stats is not None and index > 0 and not np.isnan(skews[index]):
+                    stats.update("uut_skew", skews[index], uut=uut.s0.HN, bin_width=0.25, nbins=40)
+            if not regression_analysis.check_skew(skews, args.max_skew):
+                fail(args, iteration, "UUT skew out of limits.", uuts, 0)
+
+        mark_phase(args, "save")
+        if streamed is None:
+            save_data(uuts, data, channels, args)
+        else:
+            save_previews(uuts, data, channels, args) # The data files were written as it arrived.
+        save_index(uuts, data, channels, args, iteration, events, sample_counter)
+        mark_phase(args, "metrics")
+        params = regression_analysis.get_analysis_params(args, get_stl(args))
+        analysis = None
+        if args.workers > 0:
+            analysis = args.pool.analyse(data, params, args.offload_windows_used)
+            metrics = save_spectral_metrics(uuts, data, channels, args, iteration,
+                                            [[channel["metrics"] for channel in uut_analysis] for uut_analysis in analysis])
+        else:
+            metrics = save_spectral_metrics(uuts, data, channels, args, iteration)
+        mark_phase(args, "channels")
         for index, data_set in enumerate(data):
             for num, ch in enumerate(channels[index]):
                 channel_data = data[index][:, num]
-                if args.test == "pre_post":
-                    ideal_data = regression_analysis.get_ideal_data(args.test, args.trg, args.event, data=channel_data, pre=args.pre, post=args.post)
+                if analysis is not None:
+                    ideal_data = analysis[index][num]["ideal"]
+                else:
+                    ideal_data = regression_analysis.get_channel_ideal(params, channel_data, rows)
+                if args.test in ("rtm", "rgm", "rtm_gpg"):
+                    model = regression_analysis.get_test_stl_model(args.test, args.event, get_stl(args), channel_data.shape[-1], translen=args.rtm_translen)
+                    bursts = regression_analysis.analyse_bursts(channel_data, ideal_data,
+                                                                es_indices=regression_analysis.get_es_positions(events[index]) if args.demux == 0 else None,
+                                                                expected_es=model["es_positions"] if model is not None else None)
+                    regression_analysis.print_bursts(bursts)
+                    summary = regression_analysis.get_bursts_summary(bursts)
+                    save_results(args, index, dict(summary, type="bursts", iteration=iteration,
+                                                   uut=uuts[index].s0.HN, channel=ch))
+                    if summary["nfailed"]:
+                        fail(args, iteration, "{} of {} bursts failed.".format(summary["nfailed"], summary["bursts"]),
+                             uuts, index, ch, [("real", channel_data), ("ideal", ideal_data)], {"bursts": summary})
+                if analysis is not None:
+                    offset = analysis[index][num]["offset"]
+                else:
+                    offset = regression_analysis.get_offset(channel_data, ideal_data, max_lag=regression_analysis.get_max_lag(args))
+                save_results(args, index, {"type": "alignment", "iteration": iteration, "uut": uuts[index].s0.HN,
+                                           "channel": ch, "offset": float(offset)})
+                if not regression_analysis.check_jitter(offset, args.max_jitter):
+                    fail(args, iteration, "Offset from model out of limits.", uuts, index, ch,
+                         [("real", channel_data), ("ideal", ideal_data)])
+                if args.align == 1:
+                    ideal_data = regression_analysis.shift(ideal_data, offset)
+                if stats is not None:
+                    if streamed is not None:
+                        spad_gaps = len(streamed[index]["spad_gaps"])
+                    else:
+                        spad_gaps = len(regression_analysis.get_sample_counter_gaps(sample_counter[index], args.test, rows)) if sample_counter != [] else np.nan
+                    update_loop_stats(stats, uuts[index].s0.HN, ch, channel_data, ideal_data, metrics[index][num], spad_gaps, offset)
+                if args.live_view is not None and index == 0 and num == 0:
+                    args.live_view.update("{} {} CH{}".format(get_step_name(args), uuts[index].s0.HN, ch),
+                                          iteration, channel_data, ideal_data, offset)
+                # The compare may already have been made, in flight or by the pool.
+                if analysis is not None:
+                    passed = analysis[index][num]["compare"]
                 else:
-                    ideal_data = regression_analysis.get_ideal_data(args.test, args.trg, args.event, data=channel_data)
-                result = regression_analysis.compare(channel_data, ideal_data, args.test, args.trg, args.event)
+                    passed = streamed is not None and streamed[index]["compare"] is not None and streamed[index]["compare"][num]
+                if passed:
+                    print("Data comparison result: True")
+                    result = True
+                else:
+                    result = regression_analysis.compare(channel_data, ideal_data, args.test, args.trg, args.event, plot=args.headless != 1)
+                if not result:
+                    fail(args, iteration, "DATA COMPARISON FAILED", uuts, index, ch,
+                         [("real", channel_data), ("ideal", ideal_data - 2000)])
                 if sample_counter != []:
-                    spad_test = regression_analysis.check_sample_counter(sample_counter[index], args.test)
+                    spad_test = regression_analysis.check_sample_counter(sample_counter[index], args.test, exit_on_fail=args.headless != 1, rows=rows,
+                                                                         gaps=streamed[index]["spad_gaps"] if streamed is not None else None)
                     print("SPAD TEST FAILED!" if spad_test != [] else "SPAD TEST PASSED!")
+                    if spad_test != []:
+                        fail(args, iteration, "Discontinuities in sample counter: {}".format(spad_test[:10]), uuts, index, ch,
+                             [("sample counter", sample_counter[index])])
                 elif args.demux == 1:
                     print(AnsiCol.CYELLOW, "Can't access SPAD when demux = 1. If SPAD analysis is required please set demux = 0.", AnsiCol.CEND)
 
         if args.custom_test == 1:
             custom_test(args, uuts)
+        mark_phase(args, None)
+        save_memory(args, iteration, stats)
+        save_timing(args, iteration)
 
         if success_flag == False:
-            print(AnsiCol.CRED , "There is a problem with the event samples. Please check them by hand. Exiting now. " , AnsiCol.CEND)
-            print("Tests run: ", iteration)
-            exit(1)
+            fail(args, iteration, "There is a problem with the event samples. Please check them by hand.", uuts, 0)
         else:
             print(AnsiCol.CGREEN + "Test successful. Test number: ", iteration, AnsiCol.CEND)
 
  
-@acq400_hapi.timing
+@timing
 def run_test(args, uuts):
     verify_inputs(args)
 
+    step = args.checkpoint["steps"].setdefault(get_step_name(args), {"completed": 0, "done": False})
+    if step["done"]:
+        print("Skipping '{}', it was completed by the run being resumed.".format(get_step_name(args)))
+        return None
+    step.pop("failed", None) # A step that failed is run again from the failed test.
+
     if args.wave_scale == 'auto':
         scale = get_module_voltage(uuts[0])
     args.is_43X = uuts[0].s1.MODEL.startswith("ACQ43")
 
-    sig_gen = socket.socket()
-    sig_gen.connect((args.sig_gen_name, 5025))
+    sig_gen = connect_sig_gen(args)
 
     if args.config_sig_gen == 1:
         freq = calculate_frequency(args, uuts[0], args.clock_divisor)
         configure_sig_gen(sig_gen, args, freq, scale)
 
-    for iteration in list(range(1, args.loops+1)):
-        run_test_iteration(args, uuts, iteration, sig_gen)
+    stats = load_step_stats(args)
+    if step["completed"]:
+        print("Resuming '{}' from test number {}.".format(get_step_name(args), step["completed"]+1))
+    for iteration in list(range(step["completed"]+1, args.loops+1)):
+        args.metrics.start_iteration(get_step_name(args), iteration, args.loops)
+        try:
+            with iteration_output(args):
+                run_test_iteration(args, uuts, iteration, sig_gen, stats)
+        except TestFailure:
+            print(AnsiCol.CRED + "Stopping '{}' test after failure. Tests run: {}".format(args.test, iteration), AnsiCol.CEND)
+            step["failed"] = iteration
+            publish_metrics(args, force=True)
+            break
+        finally:
+            # A failure leaves its phase running; anything after it isn't in that phase.
+            mark_phase(args, None)
+        args.metrics.result(True)
+        publish_metrics(args)
+        step["completed"] = iteration
+        save_checkpoint(args, stats)
         # code.interact(local=locals())
+    step["done"] = "failed" not in step
+    save_checkpoint(args, stats)
+    save_loop_stats(uuts, args, stats)
     print(AnsiCol.CBLUE);print("Finished '{}' test. Total tests run: {}".format(args.test, args.loops));print(AnsiCol.CEND)
 
     return None
 
+
+SOAK_RATE_FRACTIONS = (0.25, 0.5, 0.75, 1)
+
+
+def soak_shot(args, uuts, data_size, agg_chans, nchans, pre):
+    """
+    One soft triggered pre_post capture with only the light checks. A soft
+    event after pre samples puts one event sample in the data. Returns the
+    number of SPAD discontinuities (other than the expected step at the
+    PRE/POST boundary) and of missing, bad or mismatched event samples.
+    """
+    for uut in reversed(uuts): # Slaves first, so they're ready for the master.
+        uut.s0.set_arm
+    for uut in uuts:
+        uut.statmon.wait_armed()
+    while uuts[0].statmon.get_elapsed() <= uuts[0].statmon.get_pre():
+        pass # The soft trigger has started PRE, the event must come after it.
+    uuts[0].s0.soft_trigger = 1
+    for uut in uuts:
+        uut.statmon.wait_stopped()
+
+    offload_start = time.time()
+    gaps = 0
+    bad_es = 0
+    positions = []
+    nbytes = 0
+    for index, uut in enumerate(uuts):
+        raw = uut.read_chan(0, 0, data_size=data_size)
+        nbytes += raw.nbytes
+        sample_counter = regression_analysis.extract_sample_counter(raw, agg_chans[index], nchans[index])
+        gaps += len([gap for gap in regression_analysis.get_sample_counter_gaps(sample_counter, "post") if gap[0] != pre - 1])
+        events = regression_analysis.get_es_records(uut, data=raw)
+        bad_es += regression_analysis.check_es_magic(events).shape[-1]
+        positions.append(regression_analysis.get_es_positions(events))
+        if positions[index].shape[-1] != 1 or not np.array_equal(positions[index], positions[0]):
+            bad_es += 1
+    args.metrics.offload(nbytes, time.time() - offload_start)
+    return gaps, bad_es
+
+
+def get_soak_rates(args, uuts):
+    # The sample rates to soak at: --soak_rates, or fractions of the rate the UUTs run at.
+    if args.soak_rates is not None:
+        return [int(float(rate)) for rate in args.soak_rates.split(",")]
+    return [int(get_sample_rate(args, uuts[0]) * fraction) for fraction in SOAK_RATE_FRACTIONS]
+
+
+def set_soak_rate(uuts, rate):
+    for index, uut in enumerate(uuts):
+        uut.s0.sync_role = "{} {}".format("master" if index == 0 else "slave", rate)
+    return None
+
+
+def run_soak(args, uuts):
+    """
+    Finds the highest reliable shot rate of the UUTs. Short soft triggered
+    pre_post captures, with a soft event after --soak_pre samples, are run
+    back to back with no waits beyond the UUT state changes, and only the
+    SPAD continuity and the event sample are checked. Each sample rate (see
+    get_soak_rates) and capture length in --soak_lengths is run for
+    --soak_shots shots or --soak_seconds, whichever comes first, and stops
+    at its first failed shot. Prints the sustained shots/hour of each step
+    and the best step with no discontinuities. The sync_role each UUT had
+    before the soak (its role, clock and rate) is set again at the end.
+    """
+    if args.demux != 0:
+        print("--soak=1 needs --demux=0 to check the SPAD.")
+        exit(1)
+    args.is_43X = uuts[0].s1.MODEL.startswith("ACQ43")
+    original_roles = [uut.s0.sync_role for uut in uuts]
+    rates = get_soak_rates(args, uuts)
+    lengths = [int(length) for length in args.soak_lengths.split(",")]
+    results = []
+
+    try:
+        for rate in rates:
+            set_soak_rate(uuts, rate)
+            sample_rate = get_sample_rate(args, uuts[0])
+
+            for length in lengths:
+                pre = min(args.soak_pre, length) # PRE can't be longer than POST.
+                for index, uut in enumerate(uuts):
+                    if index == 0:
+                        regression_setup.configure_pre_post(uut, "master", trigger=[1,1,1], event=[1,1,1], pre=pre, post=length)
+                    else:
+                        regression_setup.configure_pre_post(uut, "slave", pre=pre, post=length)
+                data_size = 4 if uuts[0].s0.data32 == '1' else 2
+                agg_chans = [regression_analysis.get_agg_chans(uut) for uut in uuts]
+                nchans = [uut.nchan() for uut in uuts]
+
+                step = "soak_{}_{}".format(sample_rate, length)
+                shots = gaps = bad_es = 0
+                start = time.time()
+                while shots < args.soak_shots and time.time() - start < args.soak_seconds:
+                    args.metrics.start_iteration(step, shots + 1, args.soak_shots)
+                    shot_gaps, shot_bad_es = soak_shot(args, uuts, data_size, agg_chans, nchans, pre)
+                    shots += 1
+                    gaps += shot_gaps
+                    bad_es += shot_bad_es
+                    passed = shot_gaps == 0 and shot_bad_es == 0
+                    args.metrics.result(passed, None if passed else "{} discontinuities, {} bad ES".format(shot_gaps, shot_bad_es))
+                    publish_metrics(args)
+                    if not passed:
+                        break
+                elapsed = time.time() - start
+
+                record = {"type": "soak", "sample_rate": sample_rate, "pre": pre, "length": length, "shots": shots,
+                          "seconds": elapsed, "shots_per_hour": shots / elapsed * 3600,
+                          "capture_duty": shots * (pre + length) / sample_rate / elapsed if sample_rate else None,
+                          "gaps": gaps, "bad_es": bad_es, "passed": gaps == 0 and bad_es == 0}
+                results.append(record)
+                with open("{}/soak_results.jsonl".format(args.directories[0]), "a") as results_file:
+                    results_file.write(json.dumps(record) + "\n")
+                print((AnsiCol.CGREEN if record["passed"] else AnsiCol.CRED) +
+                      "{} Hz {:>9} samples: {:>5} shots in {:.1f} s, {:.0f} shots/hour, {} discontinuities, {} bad ES".format(
+                          sample_rate, length, shots, elapsed, record["shots_per_hour"], gaps, bad_es), AnsiCol.CEND)
+    finally:
+        for uut, role in zip(uuts, original_roles):
+            uut.s0.sync_role = role
+            print("{} sync_role set back to {}.".format(uut.s0.HN, role))
+
+    passed = [record for record in results if record["passed"]]
+    summary = {"steps": results,
+               "best": max(passed, key=lambda record: record["shots_per_hour"]) if passed else None,
+               "highest_rate": max(record["sample_rate"] for record in passed) if passed else None}
+    with open("{}/soak_summary.json".format(args.directories[0]), "w") as summary_file:
+        json.dump(summary, summary_file, indent=1)
+
+    if summary["best"] is None:
+        print(AnsiCol.CRED + "No step of the soak ran without discontinuities.", AnsiCol.CEND)
+        args.failures.append({"test": "soak", "trg": None, "event": None, "iteration": None,
+                              "reason": "no step ran without discontinuities"})
+    else:
+        print(AnsiCol.CBLUE + "Highest shot rate with no discontinuities: {shots_per_hour:.0f} shots/hour "
+              "({length} samples at {sample_rate} Hz)".format(**summary["best"]), AnsiCol.CEND)
+        print(AnsiCol.CBLUE + "Highest sample rate with no discontinuities: {} Hz".format(summary["highest_rate"]), AnsiCol.CEND)
+    return results
+
+
+def is_connected(sock):
+    # False if the other end has closed the connection (it reads as EOF).
+    try:
+        readable, writable, errors = select.select([sock], [], [], 0)
+        return not readable or sock.recv(1, socket.MSG_PEEK) != b""
+    except (OSError, ValueError):
+        return False
+
+
+def get_pool(args):
+    # The daemon keeps worker pools between runs in args.pools.
+    import regression_pool
+    pools = getattr(args, "pools", None)
+    if pools is None:
+        return regression_pool.AnalysisPool(args.workers)
+    if args.workers not in pools:
+        pools[args.workers] = regression_pool.AnalysisPool(args.workers)
+    return pools[args.workers]
+
+
+def connect_sig_gen(args):
+    # The daemon keeps sig gen connections open between runs in args.sig_gens.
+    sig_gens = getattr(args, "sig_gens", None)
+    if sig_gens is not None and args.sig_gen_name in sig_gens:
+        if is_connected(sig_gens[args.sig_gen_name]):
+            return sig_gens[args.sig_gen_name]
+        sig_gens.pop(args.sig_gen_name).close() # The sig gen has dropped it, make a new one.
+    sig_gen = socket.socket()
+    sig_gen.connect((args.sig_gen_name, 5025))
+    if sig_gens is not None:
+        sig_gens[args.sig_gen_name] = sig_gen
+    return sig_gen
+
+
+def get_uuts(args):
+    # The daemon keeps UUT connections open between runs in args.uut_cache.
+    import acq400_hapi
+    uut_cache = getattr(args, "uut_cache", {})
+    for name in args.uuts:
+        if name not in uut_cache:
+            uut_cache[name] = acq400_hapi.factory(name)
+    return [uut_cache[name] for name in args.uuts]
+
+
 def reset_uut(args, uut):
     uut.s0.set_abort
     uut.s0.transient = "DEMUX={}".format(args.demux)
@@ -512,8 +1098,146 @@ def get_parser():
     parser.add_argument('--post', default=1048576, type=int, 
     help="set post length for pre/post")
     
+    parser.add_argument('--offload_windows', default=0, type=int,
+    help="1 to offload only some windows of a pre_post capture: the head, the \
+    PRE/POST boundary and --random_blocks random blocks. The data, ES and SPAD \
+    are only checked in those windows. Much quicker for soak runs, but the read \
+    stops at the end of the boundary window: with the default lengths only the \
+    first ~6%% of the capture is offloaded, and the rest of POST is never \
+    checked.")
+
+    parser.add_argument('--window_margin', default=1000, type=int,
+    help="Samples offloaded either side of the sine wave at the PRE/POST boundary \
+    with --offload_windows=1.")
+
+    parser.add_argument('--block_len', default=4096, type=int,
+    help="Length in samples of the head and random blocks with --offload_windows=1.")
+
+    parser.add_argument('--random_blocks', default=8, type=int,
+    help="Number of random blocks offloaded with --offload_windows=1.")
+
+    parser.add_argument('--offload_tail', default=0, type=int,
+    help="1 to check the whole capture with --offload_windows=1. The capture is \
+    read from the start, so reaching the tail reads the whole buffer, and all \
+    of it is analysed: there is no saving over a full offload.")
+
+    parser.add_argument('--stream', default=0, type=int,
+    help="1 to analyse the raw data while it is still being offloaded. The ES \
+    scan, SPAD check, data files and (for pre_post without --align) compare \
+    run on each chunk as it arrives. Needs --demux=0.")
+
+    parser.add_argument('--stream_chunk', default=65536, type=int,
+    help="Number of samples in each chunk with --stream=1.")
+
+    parser.add_argument('--workers', default=0, type=int,
+    help="Number of worker processes for the per channel analysis (spectral \
+    metrics, alignment and compare). 0 runs it all in this process.")
+
+    parser.add_argument('--soak', default=0, type=int,
+    help="1 to find the highest reliable shot rate instead of running --test. \
+    Short soft triggered pre_post captures with a soft event are run back to back, \
+    with only the SPAD and the event sample checked, for each --soak_rates and \
+    --soak_lengths. Needs --demux=0. The sample rate is set back at the end.")
+
+    parser.add_argument('--soak_lengths', default="10000,100000,1000000", type=str,
+    help="Comma separated capture lengths (POST samples) for --soak=1.")
+
+    parser.add_argument('--soak_pre', default=5000, type=int,
+    help="PRE samples before the soft event of each --soak=1 shot (at most the \
+    POST length). Default is 5000.")
+
+    parser.add_argument('--soak_rates', default=None, type=str,
+    help="Comma separated sample rates in Hz for --soak=1, set with sync_role. \
+    Default is 25%%, 50%%, 75%% and 100%% of the rate the UUTs run at.")
+
+    parser.add_argument('--soak_shots', default=100, type=int,
+    help="Most shots of each --soak=1 step. Default is 100.")
+
+    parser.add_argument('--soak_seconds', default=60, type=float,
+    help="Most seconds of each --soak=1 step. Default is 60.")
+
+    parser.add_argument('--live', default=0, type=int,
+    help="1 to show the first channel of the master, its residual and trends \
+    in a live window during the loop. The window never holds the loop up; \
+    shots are skipped if it falls behind.")
+
+    parser.add_argument('--live_fps', default=5, type=float,
+    help="Most redraws per second of the --live=1 window. Default is 5.")
+
+    parser.add_argument('--metrics_file', default=None, type=str,
+    help="Prometheus textfile to rewrite with the live metrics of the run after \
+    every iteration, e.g. for the node exporter textfile collector.")
+
+    parser.add_argument('--metrics_port', default=None, type=int,
+    help="Serve the live metrics on http://127.0.0.1:<port>/metrics.")
+
+    parser.add_argument('--status_interval', default=10, type=float,
+    help="Seconds between status lines (rate, offload speed, passes and failures). \
+    Default is 10.")
+
+    parser.add_argument('--quiet', default=0, type=int,
+    help="1 to only print the output of an iteration if it fails. The status \
+    line is still printed.")
+
+    parser.add_argument('--profile', default=0, type=int,
+    help="1 to sample the Python stack during every iteration, and write the \
+    totals for the run to profile.txt and profile.collapsed (for flame graphs) \
+    in the results directory of the master.")
+
+    parser.add_argument('--profile_phases', default="all", type=str,
+    help="Comma separated phases to profile with --profile=1: configure, offload, \
+    es, skew, save, metrics, channels. Default is all.")
+
+    parser.add_argument('--profile_interval', default=5, type=float,
+    help="Milliseconds between samples with --profile=1. Default is 5.")
+
+    parser.add_argument('--memory', default=0, type=int,
+    help="1 to record the peak allocations and RSS growth of each phase of \
+    every iteration, in the results of the master. Slows the analysis a little.")
+
+    parser.add_argument('--memory_budget', default=None, type=float,
+    help="With --memory=1, print the largest allocations of any phase that \
+    allocates more than this many MB at its peak.")
+
+    parser.add_argument('--rtm_translen', default=5000, type=int,
+    help="set RTM_TRANSLEN for rtm and rtm_gpg")
+
+    parser.add_argument('--rtm_post', default=50000, type=int,
+    help="set post length for rtm and rtm_gpg")
+
+    parser.add_argument('--align', default=0, type=int,
+    help="If 1, shift the model by the measured offset of each channel before \
+    comparing. Default is 0.")
+
+    parser.add_argument('--align_search', default=1000, type=int,
+    help="Largest offset in samples to search for when aligning a channel with \
+    its model. Default is 1000.")
+
+    parser.add_argument('--max_jitter', default=None, type=float,
+    help="Fail a shot if a channel is offset from its model by more than this \
+    many samples. Default is no limit.")
+
+    parser.add_argument('--max_skew', default=None, type=float,
+    help="Fail a shot if the first channel of any UUT is skewed from the master \
+    by more than this many samples. Default is no limit.")
+
+    parser.add_argument('--headless', default=0, type=int,
+    help="If 1, never open a plot window or exit on a failure. Failures are \
+    saved as records, plotted to PNG in the background, and the rest of the \
+    tests carry on. Default is 0.")
+
+    parser.add_argument('--resume', default=None, type=str,
+    help="Resume an interrupted run from its (master) results directory, e.g. \
+    ./results/ACQ423ELF/ACQ1001_TOP_09_09_32B/acq1001_084_2207231352. Steps that \
+    passed are skipped, and the loop carries on from the last test that passed.")
+
     parser.add_argument('--plot_previous', default=None, 
     help="plot a previous result")
+
+    parser.add_argument('--plot_previews', default=0, type=int,
+    help="1 to plot the saved previews of --test under the --plot_previous \
+    directory instead of the full data, e.g. ./results/ACQ423ELF to overlay \
+    a test across FPGA builds.")
     
     parser.add_argument('--fudge_pp_event_time', default=2, type=int, 
     help="wait a few more seconds before pulling event trigger (this should be randomized)")
@@ -529,19 +1253,59 @@ def run_main(args):
     all_trgs =   [[1,0,0], [1,0,1], [1,1,1]]
     all_events = [[1,0,0], [1,0,1]] # Not interested in any soft events.
 
-    uuts = [acq400_hapi.factory(u) for u in args.uuts]
+    uuts = get_uuts(args)
 
     for uut in uuts:
         reset_uut(args, uut)
         
     if args.plot_previous:
         args.directories = [ args.plot_previous ]
-        regression_visualisation.view_last_run(args, uuts)
+        import regression_visualisation
+        if args.plot_previews == 1:
+            regression_visualisation.view_previews(args)
+        else:
+            regression_visualisation.view_last_run(args, uuts)
         return        
 
-    args.directories = regression_setup.create_results_dir(uuts)
-
-    if args.test.lower() == "all":
+    if args.resume:
+        args.checkpoint = load_checkpoint(args.resume)
+        args.directories = args.checkpoint["directories"]
+        if strip_resume(sys.argv[1:]) != strip_resume(args.checkpoint["argv"]):
+            print(AnsiCol.CYELLOW + "Warning: the arguments are not the same as the run being resumed: {}".format(
+                " ".join(args.checkpoint["argv"])), AnsiCol.CEND)
+        print("Resuming run in {}".format(" ".join(args.directories)))
+    else:
+        args.directories = regression_setup.create_results_dir(uuts)
+        args.checkpoint = {"argv": sys.argv[1:], "directories": args.directories, "steps": {}}
+        save_checkpoint(args)
+    args.failures = []
+    import regression_metrics
+    args.metrics = regression_metrics.Metrics(args.status_interval)
+    if args.metrics_port is not None:
+        args.metrics.serve(args.metrics_port)
+    args.memory_monitor = None
+    args.profiler = None
+    args.live_view = None
+    if args.live == 1:
+        import regression_live
+        args.live_view = regression_live.LiveView(args.live_fps)
+    if args.profile == 1:
+        import regression_profile
+        args.profiler = regression_profile.SamplingProfiler(args.profile_interval / 1000,
+                                                            None if args.profile_phases == "all" else args.profile_phases.split(","))
+    if args.memory == 1:
+        import regression_memory
+        args.memory_monitor = regression_memory.MemoryMonitor(args.memory_budget)
+    if args.workers > 0:
+        args.pool = get_pool(args)
+    if args.headless == 1:
+        import regression_render
+        args.renderer = regression_render.PlotRenderer()
+
+    if args.soak == 1:
+        run_soak(args, uuts)
+
+    elif args.test.lower() == "all":
         print("You have selected to run all tests.")
         print("Now running each test {} times with ALL triggers " \
                                 "and ALL events.".format(args.loops))
@@ -637,9 +1401,31 @@ def run_main(args):
         run_test(args, uuts)
 
     print(AnsiCol.CCYAN+"Elapsed time = ",time.strftime('%H:%M:%S', time.gmtime(time.time()-start)),AnsiCol.CEND)
+    publish_metrics(args, force=True)
+    args.metrics.close()
+    if args.live_view is not None:
+        args.live_view.close()
 
     # regression_analysis.test_info(args, uut)
-    regression_visualisation.view_last_run(args, uuts)
+    if args.memory_monitor is not None:
+        args.memory_monitor.close()
+    if args.profiler is not None:
+        args.profiler.close()
+        args.profiler.write(args.directories[0])
+        print("\n".join(args.profiler.get_report(top=15)))
+        print("Profile written to {0}/profile.txt and {0}/profile.collapsed".format(args.directories[0]))
+    if args.workers > 0 and getattr(args, "pools", None) is None:
+        args.pool.close()
+    if args.headless == 1:
+        args.renderer.close()
+        for failure in args.failures:
+            print(AnsiCol.CRED + "FAILED: {test} trg {trg} event {event} iteration {iteration}: {reason}".format(**failure), AnsiCol.CEND)
+        print("{} failures.".format(len(args.failures)))
+        if args.failures:
+            sys.exit(1)
+    else:
+        import regression_visualisation
+        regression_visualisation.view_last_run(args, uuts)
 
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@ import os
 import matplotlib.pyplot as plt
 import numpy as np
 import regression_setup
+import regression_analysis
 
 
 def get_data_from_dirs_list(args, uuts, dirs):
@@ -22,7 +23,7 @@ def get_data_from_dirs_list(args, uuts, dirs):
         for dir in gen:
             if dir.split("/")[-2].startswith("rtm_gpg") and test == "rtm":
                 continue
-            files = [dir + "/" + name for name in os.listdir(dir)]
+            files = [dir + "/" + name for name in os.listdir(dir) if name.endswith("_data.dat")]
 
             for file in files:
 
@@ -57,6 +58,44 @@ def get_file_list(directory):
     return file_list
 
 
+def plot_failure(real_data, ideal_data):
+    # Show a failed data comparison, with the ideal data offset below the real data.
+    plt.plot(real_data)
+    plt.plot(ideal_data-2000)
+    plt.grid(True)
+    plt.show()
+    return None
+
+
+def plot_previews(files, points=2000):
+    """
+    Overlays the saved previews of many channels, e.g. the same test across
+    several FPGA directories under results/{MODEL}/, without reading their
+    full data files.
+    """
+    plt.figure()
+    for file in files:
+        positions, values = regression_analysis.load_preview(file, points)
+        plt.plot(positions, values, label=os.path.relpath(file))
+    plt.grid(True)
+    if len(files) <= 10:
+        plt.legend()
+    plt.show()
+    return None
+
+
+def view_previews(args):
+    # Plot the previews of args.test under the --plot_previous directory.
+    prefix = "" if args.test == "all" else args.test + "_ch_"
+    files = [file for file in get_file_list(args.directories[0])
+             if file.endswith("_preview.npz") and os.path.basename(file).startswith(prefix)]
+    if not files:
+        print("No {} previews under {}.".format(args.test, args.directories[0]))
+        return None
+    plot_previews(sorted(files))
+    return None
+
+
 def view_last_run(args, uuts):
     directories = args.directories.copy()
     dirs = [directories[0] + "/" + name + "/" for name in os.listdir(directories[0])]